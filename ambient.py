@@ -1,5 +1,4 @@
 import os
-import requests
 import logging
 
 from weatherprovider import WeatherProvider
@@ -19,8 +18,7 @@ class Ambient(WeatherProvider):
             ('applicationKey', self.app_key),
             ('apiKey', self.api_key),
         )
-        response = requests.get(f'{self.endpoint}{self.device_mac}', params = params)
-        return response.json()
+        return self.get_json(self.device_mac, params, label='ambient')
 
     # Get the current weather conditions from Ambient Weather device
     def get_weather(self):
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+import sys
+import os
+import time
+import json
+import inspect
+import logging
+import pkgutil
+import argparse
+import importlib
+import statistics
+import tracemalloc
+
+# The drivers talk to the virtual panel, so this runs on any machine
+os.environ['EPD_BACKEND'] = 'virtual'
+os.environ.setdefault('OPEN_WEATHER_MAP_API_KEY', 'sample')
+os.environ.setdefault('WEATHER_ZIP_CODE', '98223')
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
+if os.path.exists(libdir):
+    sys.path.append(libdir)
+
+from PIL import Image,ImageDraw
+import waveshare_epd
+from waveshare_epd import epdconfig
+
+from openweathermap import OpenWeatherMap
+
+# Arguments for the init methods that need one, by parameter name
+INIT_ARGS = {
+    'lut': lambda epd: epd.lut_full_update,
+    'update': lambda epd: epd.FULL_UPDATE,
+    'mode': lambda epd: 0,
+}
+
+# Names of every driver module in waveshare_epd
+def driver_names():
+    return sorted(
+        m.name for m in pkgutil.iter_modules(waveshare_epd.__path__)
+        if m.name.startswith('epd') and m.name not in ('epdconfig', 'epdbuffer'))
+
+# Run fn repeat times and return its result with the median wall time, then
+# once more under tracemalloc for the peak Python allocation
+def measure(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {
+        'wall_s': statistics.median(times),
+        'wall_min_s': min(times),
+        'peak_alloc_kib': round(peak / 1024, 1),
+    }
+
+# Run fn against the virtual panel and add what it sent to the stage result
+def measure_panel(fn, repeat):
+    panel = epdconfig.implementation
+    panel.clear_capture()
+    fn()
+    sent = dict(panel.stats)
+
+    result, stage = measure(fn, repeat)
+    stage.update(
+        commands=sent['commands'],
+        data_bytes=sent['data_bytes'],
+        transfers=sent['transfers'],
+        spi_s=round(sent['spi_time'], 6),
+        busy_s=round(sent['busy_time'], 6))
+    return result, stage
+
+# Render the weather display from the OpenWeatherMap sample data. Falls back
+# to a test pattern when the display can't be drawn on this machine (no
+# Font.ttc, no netifaces ...).
+def render_frame(repeat):
+    try:
+        import display
+
+        openWeather = OpenWeatherMap()
+        openWeather._get = openWeather.sample_data_weather
+        w = openWeather.get_weather()
+        f = openWeather.sample_data_forecast()
+        return measure(lambda: display.draw((800, 480), w, f), repeat)
+    except Exception as e:
+        logging.warning(f"Cannot render the display, using a test pattern: {e!r}")
+
+    image = Image.new('1', (800, 480), 255)
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 800, 40):
+        draw.line((x, 0, 800 - x, 480), fill = 0, width = 3)
+    draw.rectangle((200, 120, 600, 360), outline = 0, width = 8)
+    return image, {'error': 'render failed, test pattern used'}
+
+# Benchmark one driver: init, getbuffer and display of the frame scaled to
+# the panel size
+def bench_driver(name, frame, repeat):
+    module = importlib.import_module(f'waveshare_epd.{name}')
+    epd = module.EPD()
+    epdconfig.configure_spi(name)
+    image = frame.resize((epd.width, epd.height))
+    stages = {}
+
+    init = getattr(epd, 'init', None) or getattr(epd, 'Init')
+    args = [INIT_ARGS[p](epd) for p in inspect.signature(init).parameters]
+    _, stages['init'] = measure_panel(lambda: init(*args), repeat)
+
+    buf, stages['getbuffer'] = measure(lambda: epd.getbuffer(image), repeat)
+
+    show = getattr(epd, 'display', None) or getattr(epd, 'Display', None) or getattr(epd, 'display_1Gray')
+    planes = [buf] * len(inspect.signature(show).parameters)
+    _, stages['display'] = measure_panel(lambda: show(*planes), repeat)
+
+    return {'width': epd.width, 'height': epd.height, 'stages': stages}
+
+# Compare results with a previous run and return the stages that got slower
+# by more than threshold (0.2 = 20%)
+def regressions(results, baseline, threshold):
+    slower = []
+    for driver, result in results['drivers'].items():
+        old = baseline.get('drivers', {}).get(driver, {}).get('stages', {})
+        for stage, new in result.get('stages', {}).items():
+            if stage in old and 'wall_s' in old[stage] and 'wall_s' in new:
+                ratio = new['wall_s'] / max(old[stage]['wall_s'], 1e-9)
+                if ratio > 1 + threshold:
+                    slower.append((driver, stage, old[stage]['wall_s'], new['wall_s'], ratio))
+    return slower
+
+# Parse CLI options
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Time display.draw and each driver's getbuffer and display on the virtual panel")
+    parser.add_argument(
+        "drivers",
+        nargs="*",
+        help="Driver modules to benchmark, e.g. epd7in5_V2, default: all"
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=5,
+        help="Runs per stage, the median is reported, default=5"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Write the results as JSON to this file"
+    )
+    parser.add_argument(
+        "--compare",
+        help="JSON results of an earlier run to check for regressions"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="With --compare, report stages slower by more than this fraction, default=0.2"
+    )
+    parser.add_argument(
+        "-l",
+        "--log",
+        default="info",
+        help="Provide logging level, default='info'"
+    )
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+    logging.basicConfig(level=getattr(logging, options.log.upper()))
+
+    frame, render = render_frame(options.repeat)
+    results = {
+        'python': sys.version.split()[0],
+        'repeat': options.repeat,
+        'render': render,
+        'drivers': {},
+    }
+
+    for name in options.drivers or driver_names():
+        try:
+            results['drivers'][name] = bench_driver(name, frame, options.repeat)
+        except Exception as e:
+            logging.error(f"{name}: {e!r}")
+            results['drivers'][name] = {'error': repr(e)}
+            continue
+
+        stages = results['drivers'][name]['stages']
+        logging.info(
+            f"{name:14} getbuffer {stages['getbuffer']['wall_s'] * 1000:8.2f} ms"
+            f"  display {stages['display']['wall_s'] * 1000:8.2f} ms"
+            f"  {stages['display']['data_bytes']:7d} bytes in {stages['display']['transfers']:6d} transfers")
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        slower = regressions(results, baseline, options.threshold)
+        for driver, stage, old, new, ratio in slower:
+            logging.warning(f"{driver} {stage}: {old * 1000:.2f} ms -> {new * 1000:.2f} ms ({ratio:.2f}x)")
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+import sys
+import os
+import json
+import logging
+import argparse
+
+libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
+if os.path.exists(libdir):
+    sys.path.append(libdir)
+
+from waveshare_epd import epdconfig
+
+# Parse CLI options
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Find the fastest SPI clock that reads back intact over a MOSI to MISO loopback")
+    parser.add_argument(
+        "model",
+        nargs="?",
+        default="default",
+        help="Driver module the result is for, e.g. epd7in5_HD, default='default'"
+    )
+    parser.add_argument(
+        "--speeds",
+        type=lambda s: [int(hz) for hz in s.split(',')],
+        default=epdconfig.SPI_SPEEDS,
+        help="Comma separated clock rates to try in Hz, slowest first"
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=4096,
+        help="Bytes sent per round, default=4096"
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=3,
+        help="Rounds that must all read back intact at a clock, default=3"
+    )
+    parser.add_argument(
+        "-l",
+        "--log",
+        default="info",
+        help="Provide logging level, default='info'"
+    )
+    return parser.parse_args()
+
+def main():
+    options = parse_args()
+    logging.basicConfig(level=getattr(logging, options.log.upper()))
+
+    settings = epdconfig.spi_settings(options.model)
+    logging.info(f"SPI mode {settings['mode']}, chunk size {settings['chunk_size']}")
+    try:
+        best = epdconfig.calibrate_spi(options.speeds, options.size, options.rounds, options.model)
+    finally:
+        epdconfig.module_exit()
+
+    if best is None:
+        logging.error("No clock rate read back intact, check the MOSI to MISO wire")
+        sys.exit(1)
+
+    # settings for EPD_SPI, with the existing ones for other models kept and
+    # the mode the clock was found with
+    config = json.loads(os.environ.get('EPD_SPI', '{}'))
+    config.setdefault(options.model, {}).update(speed_hz=best, mode=settings['mode'])
+    print(f"EPD_SPI='{json.dumps(config)}'")
+
+if __name__ == "__main__":
+    main()
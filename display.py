@@ -1,14 +1,40 @@
 import os
 import logging
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
 
 import qrcode
 from PIL import Image,ImageDraw,ImageFont
 from netifaces import AF_INET
 import netifaces as ni
 
+import glyphs
+from widgets import Widget, Group, Layout, Scale
+
 picdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pic')
 
+# The panel size the coordinates below are given for. Other panels get the
+# layout scaled to fit, see widgets.Scale.
+DESIGN_SIZE = (800, 480)
+
+# Boxes (x_start, y_start, x_end, y_end) of the parts of the display that
+# change on every refresh whatever the weather: the "updated: HH:MM" time.
+# See volatile_regions for a panel's pixels.
+VOLATILE_REGIONS = [(675, 184, 800, 205)]
+
+# Rows of small icon + value items under the current conditions: x of each
+# icon, the value is drawn ITEM_ICON_WIDTH to its right
+ITEM_X = [30, 170, 310, 450, 590]
+ITEM_ICON_WIDTH = 25
+ITEM_Y = 180
+ITEM_Y2 = 215
+
+# Forecast day blocks, left to right from DAY_X
+DAY_X = 10
+DAY_Y = 250
+DAY_WIDTH = 156
+
 # Return a datetime object by parsing date string from forecast data
 def get_datetime(date_str):
     datetime_object = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
@@ -18,39 +44,109 @@ def get_datetime(date_str):
 def get_day_name(date):
      return date.strftime("%A")
 
+# Network interface whose address is shown with its QR code. When it is not
+# set or has no IPv4 address, the interface of the default route is used,
+# then wlan0, then any other interface that has one.
+interface = os.environ.get('FORECAST_INTERFACE')
+
+# The interface and address found by the last get_address call
+_interface = None
+_address = None
+
+# Return the IPv4 address of the named interface, None if it has none
+def _ipv4(name):
+    if not name:
+        return None
+    try:
+        address = ni.ifaddresses(name)[AF_INET][0]['addr']
+    except (ValueError, KeyError, IndexError):
+        return None
+    return None if address.startswith('127.') else address
+
+# Interfaces to try when neither the configured interface nor the last one
+# used has an address
+def _fallback_interfaces():
+    try:
+        yield ni.gateways()['default'][AF_INET][1]
+    except (KeyError, IndexError):
+        pass
+    yield 'wlan0'
+    yield from ni.interfaces()
+
+# Return the address to show on the display, or None without a network. The
+# interface that worked last time is checked first, so the interfaces are
+# only searched again when it loses its address.
+def get_address():
+    global _interface, _address
+
+    for name in chain([interface, _interface], _fallback_interfaces()):
+        address = _ipv4(name)
+        if address:
+            break
+    else:
+        name, address = None, None
+
+    if (name, address) != (_interface, _address):
+        logging.info(f"Network address: {address} ({name})")
+        _interface, _address = name, address
+    return address
+
 # Generate QR Code
-def generate_qr_code(input_data):
+def generate_qr_code(input_data, box_size=1):
     logging.info("Generating QR code")
 
     qr = qrcode.QRCode(
         version=1,
-        box_size=1,
+        box_size=box_size,
         border=0)
     qr.add_data(input_data)
     qr.make(fit=True)
     img = qr.make_image(fill='black', back_color='white')
     return img
 
-# Get a display font to write with
+# QR code linking to the web display at address, generated once per address
+# and module size
+@lru_cache(maxsize=4)
+def get_qr_code(address, box_size=1):
+    return generate_qr_code(f'http://{address}', box_size)
+
+# Get a display font to write with. Each size is loaded once and reused for
+# every frame drawn by the process.
+@lru_cache(maxsize=None)
 def get_font(size):
     font_file = os.path.join(picdir, 'Font.ttc')
     f = ImageFont.truetype(font_file, size)
     return f
 
-# Return icon image based on forecast category
-def get_icon(forecast):
+# Get the glyph atlas of a display font size, see glyphs.py
+@lru_cache(maxsize=None)
+def get_glyphs(size):
+    return glyphs.get_atlas(get_font(size))
+
+# Get an image from the pic directory scaled by factor, decoded once and
+# converted to the 1 bit display mode so pasting it needs no conversion
+@lru_cache(maxsize=None)
+def get_image(name, factor=1):
+    with Image.open(os.path.join(picdir, name)) as image:
+        if factor != 1:
+            size = (max(1, round(image.width * factor)), max(1, round(image.height * factor)))
+            return image.resize(size, Image.LANCZOS).convert('1')
+        return image.convert('1')
+
+# Return the icon file name for the forecast category
+def icon_name(forecast):
     if forecast['category'] == 'Rain':
-        pouring = Image.open(os.path.join(picdir, 'weather-pouring.jpg'))
-        return pouring
+        return 'weather-pouring.jpg'
     elif forecast['category'] == "Clouds":
-        cloudy = Image.open(os.path.join(picdir, 'weather-cloudy.jpg'))
-        return cloudy
+        return 'weather-cloudy.jpg'
     elif forecast['category'] == "Snow":
-        snow = Image.open(os.path.join(picdir, 'weather-snowy.jpg'))
-        return snow
+        return 'weather-snowy.jpg'
     else:
-        sunny= Image.open(os.path.join(picdir, 'weather-sunny.jpg'))
-        return sunny
+        return 'weather-sunny.jpg'
+
+# Return icon image based on forecast category
+def get_icon(forecast):
+    return get_image(icon_name(forecast))
 
 # text description for AQI index
 def get_AQI_desc(i):    
@@ -111,252 +207,227 @@ def sunrise(w):
 def sunset(w):
     return time_adjust(w['sunset'], w['timezone'])
 
-# Draw current weather information to the display image
-def _draw_current_weather(image, w):
-    logging.info("Drawing current weather widgets")
-
-    # Date and time
-    now = datetime.now()
-    current_time = now.strftime("%H:%M")
-    current_day = now.strftime("%a")
-    current_date_str = now.strftime("%b %d")
-
-    logging.info(f"Current date: {now}")
-
-    my_ip = ni.ifaddresses('wlan0')[AF_INET][0]['addr']
-    qr = generate_qr_code(f'http://{my_ip}')
-    title = f"{w['city']}, {w['zip_code']} "
-
-    # Drawing utility
+# A widget writing the text values(data) returns at the top left of its box.
+# box and the font size are given for DESIGN_SIZE and scaled with s.
+def _text(s, name, box, size, values):
+    size = s.size(size)
+    def paint(draw, layer, xy, text):
+        draw.text(xy, text, font = get_font(size), fill = 0)
+    return Widget(name, s.box(box), values, paint)
+
+# A _text widget for numbers, times and dates, pasted from the glyph atlas
+# when it has every character of the text
+def _number(s, name, box, size, values):
+    size = s.size(size)
+    def paint(draw, layer, xy, text):
+        atlas = get_glyphs(size)
+        if atlas.can_draw(text):
+            atlas.draw(layer, xy, text)
+        else:
+            draw.text(xy, text, font = get_font(size), fill = 0)
+    return Widget(name, s.box(box), values, paint)
+
+# A widget pasting the pic values(data) names at the top left of its box
+def _icon(s, name, box, values):
+    def paint(draw, layer, xy, pic):
+        layer.paste(get_image(pic, s.factor), xy)
+    return Widget(name, s.box(box), values, paint)
+
+# Box of the value right of icon i of an item row at y
+def _item_box(i, y, width=140):
+    x = ITEM_X[i] + ITEM_ICON_WIDTH
+    return (x, y, x + width, y + 25)
+
+# Value of an optional weather field as text, None if it is missing
+def _optional(field, text):
+    return lambda data: text(data['weather']) if field in data['weather'] else None
+
+# Widgets showing the current conditions. They read the frame data from
+# render(): 'weather', 'days' and 'now'. Each box starts where its text is
+# written; longer text runs on past it as it would on the frame.
+def _current_widgets(s):
+    def sunset_text(data):
+        w = data['weather']
+        # data has an error which is returning both times as the same value.
+        # omit display of sunset if sunrise == sunset
+        return f"{sunset(w)} " if sunrise(w) != sunset(w) else None
+
+    def aqi_warning(data):
+        w = data['weather']
+        if 'pm25_indoor' in w and get_AQI_desc(w['pm25_indoor']) != 'good':
+            return f"AQI is {get_AQI_desc(w['pm25_indoor'])}! "
+        return None
+
+    def pressure(w):
+        if w['pressure_unit'] == 'mb':
+            return f"{w['pressure']:4.0f} {w['pressure_unit']} "
+        return f"{w['pressure']:2.2f} {w['pressure_unit']} "
+
+    def rain_rate(w):
+        rain = w.get('rain', {})
+        return f"{rain['rate']:2.2f} in/hr " if 'rate' in rain else "0.0 in/hr "
+
+    def rain_totals(w):
+        rain = w.get('rain', {})
+        if 'daily' in rain:
+            return f"{rain['daily']:2.2f} | {rain['weekly']:2.2f} | {rain['monthly']:2.2f} | {rain['yearly']:2.2f} "
+        return "0.0 | "
+
+    weather = lambda text: lambda data: text(data['weather'])
+
+    return [
+        # Title
+        _text(s, 'title', (10, 10, 540, 45), 24, weather(lambda w: f"{w['city']}, {w['zip_code']} ")),
+
+        # Today's Date
+        _text(s, 'day', (30, 50, 290, 140), 80, lambda data: f"{data['now'].strftime('%a')} "),
+        _text(s, 'date', (190, 105, 290, 135), 22, lambda data: f"{data['now'].strftime('%b %d')} "),
+
+        # Sunrise and Sunset
+        _number(s, 'sunrise', (320, 75, 420, 100), 18, weather(lambda w: f"{sunrise(w)} ")),
+        _number(s, 'sunset', (320, 105, 420, 130), 18, sunset_text),
+
+        # Weather Icon, Temp. and Description
+        _icon(s, 'icon', (540, 40, 590, 90), _optional('category', icon_name)),
+        _number(s, 'temp', (590, 50, 800, 155), 96, weather(lambda w: f"{w['temp']:3.0f}° ")),
+        _text(s, 'description', (470, 125, 800, 155), 18, _optional('description', lambda w: f"{w['description']} ")),
+
+        # AQI Warning
+        _text(s, 'aqi_warning', (50, 140, 470, 175), 22, aqi_warning),
+
+        # UV Index, Dew Point, pm25 Indoor, pm25 Outdoor, Temp Indoor
+        _text(s, 'uv', _item_box(0, ITEM_Y), 18, _optional('uv', lambda w: f"{w['uv']:2.0f} {get_UVI_desc(w['uv'])} ")),
+        _number(s, 'dew_point', _item_box(1, ITEM_Y), 18, _optional('dew_point', lambda w: f"{w['dew_point']:3.0f}° ")),
+        _text(s, 'pm25_indoor', _item_box(2, ITEM_Y), 18, _optional('pm25_indoor', lambda w: f"{w['pm25_indoor']:3.0f} µg/m³ I")),
+        _text(s, 'pm25_outdoor', _item_box(3, ITEM_Y), 18, _optional('aqi', lambda w: f"{w['aqi']['pm2_5']:3.0f} µg/m³ O")),
+        _number(s, 'temp_indoor', _item_box(4, ITEM_Y, 60), 18, _optional('temp_indoor', lambda w: f"{w['temp_indoor']:3.0f}° ")),
+
+        # Update time
+        _text(s, 'updated', VOLATILE_REGIONS[0], 14, lambda data: f"updated: {data['now'].strftime('%H:%M')} "),
+
+        # Wind, Humidity, Pressure, Rain
+        _text(s, 'wind', _item_box(0, ITEM_Y2), 18, weather(lambda w: f"{w['wind']['speed']:3.1f} mph {w['wind']['direction']} ")),
+        _number(s, 'humidity', _item_box(1, ITEM_Y2), 18, weather(lambda w: f"{w['humidity']:3.0f}% ")),
+        _text(s, 'pressure', _item_box(2, ITEM_Y2), 18, weather(pressure)),
+        _text(s, 'rain_rate', _item_box(3, ITEM_Y2, 100), 18, weather(rain_rate)),
+        _number(s, 'rain_totals', (575, ITEM_Y2, 800, ITEM_Y2 + 25), 18, weather(rain_totals)),
+    ]
+
+# Paste a picture of the static layer at xy and mark the area it covers on
+# the cover mask, see Layout
+def _paste_picture(image, cover, pic, xy):
+    image.paste(pic, xy)
+    cover.paste(255, xy + (xy[0] + pic.width, xy[1] + pic.height))
+
+# Draw the parts of the current conditions that don't depend on the weather
+# values: the IP/QR block, icons and the divider line, with the pictures
+# marked on cover. features lists the optional fields present, see
+# _features. Coordinates are scaled with s.
+def _draw_current_static(image, cover, s, features, my_ip):
     draw = ImageDraw.Draw(image)
 
     # Element padding
     pad = 10
 
-    # Title
-    draw.text((pad, pad), title, font = get_font(24), fill = 0)
-
-    # IP & QR Code for IP
-    draw.text((685, pad), my_ip, font = get_font(10), fill = 0)
-    image.paste(qr, (760, pad))
-
-    # ---
-
-    # Today's Date
-    draw.text((30, 50), f"{current_day} ", font = get_font(80), fill = 0)
-    draw.text((190, 105), f"{current_date_str} ", font = get_font(22), fill = 0)
+    # IP & QR Code for IP, kept on the panel when its modules don't scale down
+    if my_ip is not None:
+        draw.text(s.xy((685, pad)), my_ip, font = get_font(s.size(10)), fill = 0)
+        qr = get_qr_code(my_ip, s.size(1))
+        qr_width, qr_height = qr.size  # in pixels, qrcode's width counts modules
+        _paste_picture(image, cover, qr, (min(s.x(760), image.width - qr_width), min(s.y(pad), image.height - qr_height)))
 
     # Sunrise and Sunset
-    sunrise_pic = Image.open(os.path.join(picdir, 'sunrise.jpg'))
-    image.paste(sunrise_pic, (290 , 75))
-    draw.text((320, 75), f"{sunrise(w)} ", font = get_font(18), fill = 0)
-    
+    sunrise_pic = get_image('sunrise.jpg', s.factor)
+    _paste_picture(image, cover, sunrise_pic, s.xy((290 , 75)))
+
     # data has an error which is returning both times as the same value.
     # omit display of sunset if sunrise == sunset
-    if sunrise(w) != sunset(w):
-        sunset_pic = Image.open(os.path.join(picdir, 'sunset.jpg'))
-        image.paste(sunset_pic, (290 , 105))
-        draw.text((320, 105), f"{sunset(w)} ", font = get_font(18), fill = 0)
-
-    # Weather Icon
-    if 'category' in w:
-        icon = get_icon(w)
-        image.paste(icon, (540, 40))
-
-    # Temp.    
-    draw.text((590, 50), f"{w['temp']:3.0f}° ", font = get_font(96), fill = 0)
-
-    # Weather Description
-    if 'description' in w:
-        draw.text((470, 125), f"{w['description']} ", font = get_font(18), fill = 0)
-
-    # AQI Warning
-    if 'pm25_indoor' in w:
-        aqi = get_AQI_desc(w['pm25_indoor'])
-        if aqi != 'good':
-            draw.text((50, 140), f"AQI is {aqi}! ", font = get_font(22), fill = 0)
-    
-    # ---
-
-    item_width = 115
-    icon_width = 25 
-    y_offset = 180
-
-    # UV Index
-    x_offset = pad + 20
-    if 'uv' in w:
-        uv = Image.open(os.path.join(picdir, 'uv.jpg'))
-        image.paste(uv, (x_offset , y_offset))
-    x_offset += icon_width
-    if 'uv' in w:
-        draw.text((x_offset, y_offset), f"{w['uv']:2.0f} {get_UVI_desc(w['uv'])} ", font = get_font(18), fill = 0)
-  
-    # Dew Point
-    x_offset += item_width
-    if 'dew_point' in w:
-        dew = Image.open(os.path.join(picdir, 'star.jpg'))
-        image.paste(dew, (x_offset , y_offset))
-    x_offset += icon_width
-    if 'dew_point' in w:
-        draw.text((x_offset, y_offset), f"{w['dew_point']:3.0f}° ", font = get_font(18), fill = 0)
-
-    # pm25 Indoor
-    x_offset += item_width
-    if 'pm25_indoor' in w:
-        air = Image.open(os.path.join(picdir, 'air-filter.jpg'))
-        image.paste(air, (x_offset , y_offset))
-    x_offset += icon_width
-    if 'pm25_indoor' in w:
-        draw.text((x_offset, y_offset), f"{w['pm25_indoor']:3.0f} µg/m³ I", font = get_font(18), fill = 0)
-
-    # pm25 Outdoor
-    x_offset += item_width
-    if 'aqi' in w:
-        air = Image.open(os.path.join(picdir, 'air-filter.jpg'))
-        image.paste(air, (x_offset , y_offset))
-    x_offset += icon_width
-    if 'aqi' in w:
-        draw.text((x_offset, y_offset), f"{w['aqi']['pm2_5']:3.0f} µg/m³ O", font = get_font(18), fill = 0)
-
-    # Temp Indoor
-    x_offset += item_width
-    if 'temp_indoor' in w:
-        home = Image.open(os.path.join(picdir, 'home.jpg'))
-        image.paste(home, (x_offset , y_offset))
-    x_offset += icon_width
-    if 'temp_indoor' in w:
-        draw.text((x_offset, y_offset), f"{w['temp_indoor']:3.0f}° ", font = get_font(18), fill = 0)
-
-    # ---
-     
-    # Update time
-    x_offset += 60
-    y_offset += 4
-    draw.text((x_offset, y_offset), f"updated: {current_time} ", font = get_font(14), fill = 0)
-
-    # ---
-
-    y_offset = 215
-
-    # Wind
-    x_offset = pad + 20
-    wind = Image.open(os.path.join(picdir, 'wind.jpg'))
-    image.paste(wind, (x_offset , y_offset))
-    x_offset += icon_width
-    draw.text((x_offset, y_offset), f"{w['wind']['speed']:3.1f} mph {w['wind']['direction']} ", font = get_font(18), fill = 0)
-    
-    # Humidity
-    x_offset += item_width
-    humidity = Image.open(os.path.join(picdir, 'humidity.jpg'))
-    image.paste(humidity, (x_offset , y_offset))
-    x_offset += icon_width
-    draw.text((x_offset, y_offset), f"{w['humidity']:3.0f}% ", font = get_font(18), fill = 0)
-    
-    # Pressure
-    x_offset += item_width
-    pressure = Image.open(os.path.join(picdir, 'thermometer.jpg'))
-    image.paste(pressure, (x_offset , y_offset))
-    x_offset += icon_width
-    if w['pressure_unit'] == 'mb':
-        draw.text((x_offset, y_offset), f"{w['pressure']:4.0f} {w['pressure_unit']} ", font = get_font(18), fill = 0)
-    else:
-        draw.text((x_offset, y_offset), f"{w['pressure']:2.2f} {w['pressure_unit']} ", font = get_font(18), fill = 0)
-
-    # Rain
-    x_offset += item_width
-    drop = Image.open(os.path.join(picdir, 'drop.jpg'))
-    image.paste(drop, (x_offset , y_offset))
-    x_offset += icon_width
-
-    rain = {}
-    if 'rain' in w:
-        rain = w['rain']
-
-    if 'rate' in rain:
-        draw.text((x_offset, y_offset), f"{rain['rate']:2.2f} in/hr ", font = get_font(18), fill = 0)
-    else:
-        draw.text((x_offset, y_offset), "0.0 in/hr ", font = get_font(18), fill = 0)
-    
-    x_offset += 100
-    if 'daily' in rain:
-        draw.text((x_offset, y_offset), f"{rain['daily']:2.2f} | {rain['weekly']:2.2f} | {rain['monthly']:2.2f} | {rain['yearly']:2.2f} ",
-            font = get_font(18), fill = 0)
-    else:
-        draw.text((x_offset, y_offset), "0.0 | ", font = get_font(18), fill = 0)
-
-    # ---
+    if 'sunset' in features:
+        sunset_pic = get_image('sunset.jpg', s.factor)
+        _paste_picture(image, cover, sunset_pic, s.xy((290 , 105)))
+
+    # UV Index, Dew Point, pm25 Indoor, pm25 Outdoor, Temp Indoor
+    icons = [
+        ('uv', 'uv.jpg'),
+        ('dew_point', 'star.jpg'),
+        ('pm25_indoor', 'air-filter.jpg'),
+        ('aqi', 'air-filter.jpg'),
+        ('temp_indoor', 'home.jpg'),
+    ]
+    for x_offset, (field, name) in zip(ITEM_X, icons):
+        if field in features:
+            _paste_picture(image, cover, get_image(name, s.factor), s.xy((x_offset, ITEM_Y)))
+
+    # Wind, Humidity, Pressure, Rain
+    for x_offset, name in zip(ITEM_X, ['wind.jpg', 'humidity.jpg', 'thermometer.jpg', 'drop.jpg']):
+        _paste_picture(image, cover, get_image(name, s.factor), s.xy((x_offset, ITEM_Y2)))
 
     # Divider Line
-    y_offset += 35
-    draw.line(((pad + 20) , y_offset, (image.width - pad - 20), y_offset), fill = 0, width = 3)
+    y_offset = ITEM_Y2 + 35
+    draw.line(s.box(((pad + 20) , y_offset, (DESIGN_SIZE[0] - pad - 20), y_offset)), fill = 0, width = s.size(3))
 
     return image
 
-# Draw a forecast day block from the x,y top left corner position for the block
-def _draw_day(image, forecast, x, y):
-    logging.info("Drawing day widgets")
+# Optional fields of the current weather that have a static icon
+def _features(w):
+    features = [field for field in ('uv', 'dew_point', 'pm25_indoor', 'aqi', 'temp_indoor') if field in w]
+    if sunrise(w) != sunset(w):
+        features.append('sunset')
+    return tuple(features)
 
-    wind = Image.open(os.path.join(picdir, 'wind.jpg'))
+# Widgets of a forecast day block, relative to its top left corner with s
+# scaling from there. They read one entry of _forecast_days.
+def _day_widgets(s):
+    day_date = lambda f: get_datetime(f['date_str'])
 
-    # container size
-    width = 156
-    pad = 10
+    return [
+        # Day of week
+        _text(s, 'day', (20, 10, 95, 40), 22, lambda f: f"{day_date(f).strftime('%a')} "),
+        _number(s, 'date', (95, 16, DAY_WIDTH, 40), 16, lambda f: f"{day_date(f).strftime('%m/%d')} "),
 
-    y_offset = 0
+        # Icon
+        _icon(s, 'icon', (55, 40, 103, 88), icon_name),
 
-    # drawing utility
-    d = ImageDraw.Draw(image)
+        # Description, long ones run into the next block
+        _text(s, 'description', (25, 90, 225, 112), 16, lambda f: f"{f['description']} "),
+
+        # Temp, below the divider line of the static layer
+        _number(s, 'temp', (35, 125, DAY_WIDTH, 190), 54, lambda f: f"{f['temp']:3.0f}°"),
 
-    # Day of week
-    x_offset = x + pad
-    y_offset = y + pad
-    
-    day_date = get_datetime(forecast['date_str'])
-    day_str = f"{day_date.strftime('%a')} "
-    date_str = f"{day_date.strftime('%m/%d')} "
+        # Wind Speed, left of the wind icon
+        _text(s, 'wind', (20, 195, 100, 220), 16, lambda f: f"{f['wind_speed']:2.1f} mph"),
+    ]
 
-    d.text(((x_offset + 10), y_offset), day_str, font = get_font(22), fill = 0)
-    d.text(((x_offset + 85), (y_offset + 6)), date_str, font = get_font(16), fill = 0)
+# Draw the parts of a forecast day block that are the same every day, with
+# the pictures marked on cover and s scaling coordinates relative to the
+# block's top left corner
+def _draw_day_static(image, cover, s):
+    wind = get_image('wind.jpg', s.factor)
 
-    y_offset += 30
+    # container size
+    width = DAY_WIDTH
+    pad = 10
 
-    # Icon
-    icon = get_icon(forecast)
-    image.paste(icon, ((x + 55), y_offset))
+    d = ImageDraw.Draw(image)
 
-    # Description
-    x_offset += 15
-    y_offset += 50
-    d.text((x_offset, y_offset), f"{forecast['description']} ", font = get_font(16), fill = 0)
- 
     # Divider Line
-    x_offset -= 10
-    y_offset += 25
-    d.line((x_offset, y_offset, (x_offset + width - pad - pad - pad), y_offset), fill = 0, width = 3)
+    x_offset = pad + 5
+    y_offset = pad + 105
+    d.line(s.box((x_offset, y_offset, (x_offset + width - pad - pad - pad), y_offset)), fill = 0, width = s.size(3))
 
-    # Temp
-    x_offset += 20
-    y_offset += 10
-    d.text((x_offset, y_offset), f"{forecast['temp']:3.0f}°", font = get_font(54), fill = 0)
-
-    # Wind Speed
-    x_offset -= 15
-    y_offset += 70
-    d.text((x_offset, y_offset), f"{forecast['wind_speed']:2.1f} mph", font = get_font(16), fill = 0)
-    image.paste(wind, ((x_offset + 80), (y_offset - 5)))
+    # Wind icon, right of the speed
+    _paste_picture(image, cover, wind, s.xy((100, 190)))
 
     return image
 
-# Draw the forecast to the display image
-def _draw_forecast(image, forecast):
+# Pick the forecast entries to show, one per day
+def _forecast_days(forecast):
     logging.info("Iterating Forecast Days")
 
-    offset = 10
-    day_vert = 250
-    day_width = 156
+    days = []
     day_register = 'day'
 
-    # Iterate over forecast days in 'list' and draw widgets for each
+    # Iterate over forecast days in 'list'
     for x in forecast['list']:
         temp = x['main']['temp']
         category = x['weather'][0]['main']
@@ -373,30 +444,82 @@ def _draw_forecast(image, forecast):
             'wind_speed': wind_speed
             }
 
+        # one call data already has a single entry per day
+        if forecast.get('daily'):
+            logging.debug(f"*** Forecast: {f['date_str']} | {f['temp']}° | {f['description']}")
+            days.append(f)
+
         # forecast data returns a dict for every 3 hours. 
         # We only want daily so find unique days and get third reporting for noon for that day.
-        if day_register == day:
+        elif day_register == day:
             if "21:00:00" in f['date_str']:
                 logging.debug(f"*** Forecast: {f['date_str']} | {f['temp']}° | {f['description']}")
-                image = _draw_day(image, f, offset, day_vert) # Draw the day widget
-                offset += day_width
+                days.append(f)
             else:
                 logging.debug(f"Forecast: {f['date_str']} | {f['temp']}° | {f['description']}")
         else:
             day_register = day
-    return image
-
-# Create and draw the weather widgets onto a new display image
-def draw(dims, weather, forecast):
-    width, height = dims
+    return days
+
+# The scale of the layout on a display of size dims
+def get_scale(dims):
+    return Scale.fit(DESIGN_SIZE, dims)
+
+# VOLATILE_REGIONS on a display of size dims
+def volatile_regions(dims):
+    s = get_scale(dims)
+    return [s.box(box) for box in VOLATILE_REGIONS]
+
+# The static layer: everything that doesn't change with the weather values,
+# for a display of the given size, optional fields (see _features), address
+# and number of forecast days, and the mask of the pictures on it. Built once
+# and memoized, every frame starts from a copy of it.
+@lru_cache(maxsize=8)
+def get_background(dims, features, my_ip, days):
+    logging.info(f"Building the static display layer for {dims[0]}x{dims[1]}")
+
+    s = get_scale(dims)
+    image = Image.new('1', dims, 255)  # 255: white
+    cover = Image.new('1', dims, 0)
+    _draw_current_static(image, cover, s, features, my_ip)
+    for i in range(days):
+        _draw_day_static(image, cover, s.at(DAY_X + i * DAY_WIDTH, DAY_Y))
+    return image, cover
+
+# The widget tree for a layout with the given number of forecast days, with
+# every box and font size scaled for the display once. The day blocks are
+# placed by their scale, so their groups sit at the origin.
+def _widgets(s, days):
+    tree = _current_widgets(s)
+    for i in range(days):
+        tree.append(Group(f'day{i}', (0, 0), _day_widgets(s.at(DAY_X + i * DAY_WIDTH, DAY_Y)),
+            select=lambda data, i=i: data['days'][i] if i < len(data['days']) else None))
+    return tree
+
+# The widget layout over each static layer, keeping the last frame drawn
+# with it
+@lru_cache(maxsize=8)
+def get_layout(dims, features, my_ip, days):
+    background, cover = get_background(dims, features, my_ip, days)
+    return Layout(background, _widgets(get_scale(dims), days), cover)
+
+# Draw the weather widgets for this data. Returns the display image and the
+# boxes that changed since the last frame drawn with the same layout; only
+# the widgets whose values changed are drawn again.
+def render(dims, weather, forecast):
+    logging.info("Drawing current weather widgets")
 
-    # Create a new image to draw our display on
-    display_image = Image.new('1', (width, height), 255)  # 255: white
+    now = datetime.now()
+    logging.info(f"Current date: {now}")
 
-    # Draw current conditions to the display image
-    display_image = _draw_current_weather(display_image, weather)
+    my_ip = get_address()
+    days = _forecast_days(forecast)
 
-    # Draw the forecast to the display image
-    display_image = _draw_forecast(display_image, forecast)
+    layout = get_layout(tuple(dims), _features(weather), my_ip, len(days))
+    dirty = layout.update({'weather': weather, 'days': days, 'now': now})
+    return layout.frame.copy(), dirty
 
+# Create and draw the weather widgets onto a new display image
+def draw(dims, weather, forecast):
+    display_image, dirty = render(dims, weather, forecast)
     return display_image
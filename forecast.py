@@ -5,8 +5,13 @@ import os
 import time
 import traceback
 import logging
+import signal
+import threading
 from pprint import pformat
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 
 picdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'pic')
 libdir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'lib')
@@ -14,21 +19,260 @@ if os.path.exists(libdir):
     sys.path.append(libdir)
 
 from PIL import Image,ImageDraw,ImageFont
-from waveshare_epd import epd7in5_V2
+from waveshare_epd import epd7in5_V2, epdbuffer
 
 from ambient import Ambient
 from openweathermap import OpenWeatherMap 
+from framestore import FrameStore
 import display
+import metrics
+
+# Largest share of the panel a partial refresh may cover; a bigger change is
+# pushed with a full refresh, which takes about as long and clears ghosting
+PARTIAL_MAX_AREA = 0.5
+
+# Update e-paper display. With a frame store, nothing is done when the frame
+# hashes the same as the last one pushed, ignoring the exclude boxes, unless
+# force is set. With partial, only the window around the regions that changed
+# since the last pushed frame is refreshed, and a full refresh is forced every
+# full_every updates to clear ghosting or when the window is too large. The panel is put to sleep afterwards; keep_open
+# leaves SPI/GPIO set up for the next update. Returns True if the panel was
+# driven.
+def update_display(image, epd, store=None, partial=False, full_every=10, keep_open=False, exclude=(), force=False):
+    with metrics.stage('getbuffer'):
+        buf = epd.getbuffer(image)
+
+    # skip the whole hardware path, init and reset included, when nothing
+    # outside the excluded regions changed since the last push
+    digest = epdbuffer.frame_hash(buf, int(epd.width / 8), exclude)
+    previous, partial_count, last_digest = store.load() if store else (None, 0, None)
+    if force:
+        previous = last_digest = None
+    if digest == last_digest:
+        logging.info("Frame unchanged, skipping e-paper update")
+        return False
+
+    box = None
+    if partial and previous is not None and len(previous) == len(buf) and partial_count < full_every:
+        boxes = epdbuffer.dirty_boxes(previous, buf, int(epd.width / 8))
+        if not boxes:
+            logging.info("Frame unchanged, skipping e-paper update")
+            return False
+        box = epdbuffer.bounding_box(boxes)
+        if (box[2] - box[0]) * (box[3] - box[1]) > PARTIAL_MAX_AREA * epd.width * epd.height:
+            box = None
+
+    if box:
+        logging.info(f"Partially updating e-paper display: {box}")
+        with metrics.stage('init'):
+            epd.init_part()
+        with metrics.stage('push'):
+            epd.display_Partial(buf, *box, previous=previous)
+        partial_count += 1
+    else:
+        logging.info("Updating e-paper display")
+        with metrics.stage('init'):
+            epd.init()
+        with metrics.stage('push'):
+            epd.display(buf)
+        partial_count = 0
+
+    if store:
+        store.save(buf, partial_count, digest)
+
+    with metrics.stage('sleep'):
+        epd.sleep()
+    if not keep_open:
+        epd.Dev_exit()
+    return True
+
+# Get air pollution data. When the coordinates of the zip code are not known
+# yet they come from the current weather, or the geocoding API without it.
+def fetch_air_pollution(openWeather, weather=None):
+    coord = openWeather.coord
+    if coord is None and weather is not None:
+        c = weather.result()['coord']
+        coord = (c['lat'], c['lon'])
+    elif coord is None:
+        coord = openWeather.get_coordinates()
+    return openWeather.get_air_pollution(coord)
+
+# Get weather and forecast data from all providers at once. Each API call runs
+# in its own thread, so the wait is the slowest call rather than their sum.
+# Open Weather current conditions and forecast come from a single One Call
+# request when the API key allows it, and from the separate requests, which
+# may still have cached data to fall back on, when it fails.
+def fetch_weather(openWeather, ambient):
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        if ambient:
+            ambient_weather = pool.submit(ambient.get_weather)
+
+        w = None
+        pollution = None
+        if openWeather.one_call:
+            pollution = pool.submit(fetch_air_pollution, openWeather)
+            try:
+                w, f = openWeather.get_weather_one_call(5)
+            except requests.RequestException as e:
+                denied = isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code in (401, 403)
+                if denied:
+                    logging.warning(f"One Call API not available, using separate requests: {e}")
+                    openWeather.one_call_unavailable()
+                else:
+                    logging.warning(f"One Call request failed, using separate requests: {e}")
+
+        if w is None:
+            weather = pool.submit(openWeather.get_weather)
+            forecast = pool.submit(openWeather.get_forecast, 5)
+            if pollution is None:
+                pollution = pool.submit(fetch_air_pollution, openWeather, weather)
+            w = weather.result()
+            f = forecast.result()
+
+        w["aqi"] = pollution.result()['list'][0]['components']
+
+        logging.debug("Weather data from Open Weather:")
+        logging.debug(pformat(w))
+
+        logging.debug("Forecast data from Open Weather:")
+        logging.debug(pformat(f))
+
+        # merge data from ambient provider if it is configured
+        if ambient:
+            w.update(ambient_weather.result()) # Ambient data will overlay Open Weather Maps data if it exists.
+
+    return w, f
+
+# Fetch weather data, draw it and hand it to the panel worker, a single
+# thread executor that pushes frames to the display in order. Returns the
+# Future of the push, so the caller can carry on (write the jpeg, start the
+# next cycle, drive another panel) while the panel refreshes. Each stage is
+# timed and the cycle's metrics written out once the push is done.
+def refresh(epd, openWeather, ambient, store, options, panel):
+    logging.info("Refreshing forecast")
+    cycle = metrics.start_cycle()
+    start = time.perf_counter()
 
-# Update e-paper display
-def update_display(image, epd):
-    logging.info("Updating e-paper display")
-    epd.display(epd.getbuffer(image))
-    epd.sleep()
-    epd.Dev_exit()
+    try:
+        # get forecast data from APIs
+        with cycle.stage('fetch'):
+            w, f = fetch_weather(openWeather, ambient)
+
+        logging.info("Weather data for display:")
+        logging.info(pformat(w))
+
+        # Generate a new weather display image
+        with cycle.stage('draw'):
+            img, dirty = display.render((epd.width, epd.height), w, f)
+        logging.debug(f"Regions redrawn: {dirty}")
+
+        # Update e-paper display
+        pushed = panel.submit(push_frame, cycle, img, epd, store, options)
+
+    except BaseException:
+        finish_cycle(cycle, start, options)
+        raise
+
+    pushed.add_done_callback(lambda future: finish_cycle(cycle, start, options, future))
 
-# Parse log level to option from CLI options
-def parse_log_level():
+    # Write out image to disk as a jpeg while the panel refreshes
+    img.save('display.jpg', "JPEG")
+    return pushed
+
+# Run update_display on the panel worker with its stages recorded in cycle
+def push_frame(cycle, img, epd, store, options):
+    with metrics.use_cycle(cycle):
+        return update_display(
+            img, epd, store, options.partial, options.full_every,
+            keep_open=options.daemon, exclude=ignored_regions(options, (epd.width, epd.height)), force=options.force)
+
+# Log and write out a cycle's metrics; ok if its push completed without error
+def finish_cycle(cycle, start, options, pushed=None):
+    cycle.add('total', time.perf_counter() - start)
+    cycle.ok = pushed is not None and pushed.exception() is None
+    logging.info(f"Refresh timings: {cycle.summary()}")
+    write_metrics(cycle, options)
+
+# Pixel boxes left out when checking whether the frame changed, on a panel
+# of size dims
+def ignored_regions(options, dims):
+    regions = list(options.ignore_region)
+    if options.ignore_updated:
+        regions += display.volatile_regions(dims)
+    return regions
+
+# Write a cycle's metrics to the files given on the command line
+def write_metrics(cycle, options):
+    try:
+        if options.metrics_log:
+            cycle.write_json(options.metrics_log)
+        if options.prometheus:
+            cycle.write_prometheus(options.prometheus)
+    except OSError as e:
+        logging.warning(f"Could not write metrics: {e}")
+
+# Refresh every options.interval seconds until SIGTERM, SIGHUP or ctrl + c.
+# The interpreter, fonts, API clients and SPI/GPIO setup stay alive between
+# cycles instead of being rebuilt by every cron run. Signals only stop the
+# loop, so a refresh in progress finishes and leaves the panel asleep.
+def run_daemon(epd, openWeather, ambient, store, options, panel):
+    stop = threading.Event()
+    opened = False
+
+    # runs on the panel worker when a push is done, so it never overlaps one
+    def pushed(future):
+        nonlocal opened
+        try:
+            opened = future.result() or opened
+        except epd7in5_V2.epdconfig.BusyTimeoutError as e:
+            logging.error(e)
+            opened = True
+        except IOError as e:
+            logging.error(e)
+        except Exception:
+            # the push may have stopped with the panel powered, put it to sleep
+            logging.exception("Panel update failed")
+            opened = True
+            try:
+                epd.sleep()
+            except Exception as e:
+                logging.error(f"Could not put the panel to sleep: {e!r}")
+
+    def shutdown(signum, frame):
+        logging.info(f"Received {signal.Signals(signum).name}, stopping")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGHUP, shutdown)
+
+    next_run = time.monotonic()
+    try:
+        while not stop.is_set():
+            try:
+                refresh(epd, openWeather, ambient, store, options, panel).add_done_callback(pushed)
+            except IOError as e:
+                logging.error(e)
+            except Exception:
+                # bad data from an API shouldn't end the daemon, try again next cycle
+                logging.exception("Refresh failed")
+
+            # stay on the interval grid, skipping any slots a slow cycle overran
+            now = time.monotonic()
+            while next_run <= now:
+                next_run += options.interval
+            stop.wait(next_run - now)
+
+    except KeyboardInterrupt:
+        logging.info("ctrl + c:")
+
+    finally:
+        # let the last push finish before closing SPI/GPIO
+        panel.shutdown()
+        if opened:
+            epd.Dev_exit()
+
+# Parse CLI options
+def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-l", 
@@ -38,9 +282,64 @@ def parse_log_level():
             "Provide logging level. "
             "Example --log debug', default='info'")
     )
+    parser.add_argument(
+        "--partial",
+        action="store_true",
+        help="Only refresh the regions of the panel that changed since the last update"
+    )
+    parser.add_argument(
+        "--full-every",
+        type=int,
+        default=10,
+        help="With --partial, force a full refresh every N updates, default=10"
+    )
+    parser.add_argument(
+        "--frame-file",
+        default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'frame.bin'),
+        help="Where the last frame pushed to the panel is kept, to skip unchanged frames and for --partial"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Push the whole frame to the panel even if it is unchanged"
+    )
+    parser.add_argument(
+        "--ignore-updated",
+        action="store_true",
+        help="Don't push a frame whose only change is the 'updated' time"
+    )
+    parser.add_argument(
+        "--ignore-region",
+        type=lambda s: tuple(int(v) for v in s.split(',')),
+        action="append",
+        default=[],
+        metavar="X0,Y0,X1,Y1",
+        help="Don't push a frame whose only changes are within this box, may be repeated"
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and refresh the display every --interval seconds"
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=900,
+        help="With --daemon, seconds between refreshes, default=900"
+    )
+    parser.add_argument(
+        "--prometheus",
+        help="Write the timings of each refresh to this Prometheus textfile"
+    )
+    parser.add_argument(
+        "--metrics-log",
+        help="Append the timings of each refresh to this file as a JSON line"
+    )
 
-    options = parser.parse_args()
+    return parser.parse_args()
 
+# Parse log level option from CLI options
+def parse_log_level(options):
     levels = {
         'critical': logging.CRITICAL,
         'error': logging.ERROR,
@@ -60,47 +359,36 @@ def parse_log_level():
 
 def main():
     try:
-        logging.basicConfig(level=parse_log_level())
+        options = parse_args()
+        logging.basicConfig(level=parse_log_level(options))
 
-        logging.info("Refreshing forecast")
-
-        # get forecast data from APIs
+        # API clients, kept for every refresh in daemon mode
         openWeather = OpenWeatherMap()
-        w = openWeather.get_weather()
-        f = openWeather.get_forecast(5)
-        p = openWeather.get_air_pollution((w['coord']['lat'], w['coord']['lon']))
-        w["aqi"] = p['list'][0]['components']
-
-        logging.debug("Weather data from Open Weather:")
-        logging.debug(pformat(w))
-
-        logging.debug("Forecast data from Open Weather:")
-        logging.debug(pformat(f))
-
         # merge data from ambient provider if environment variables are setup to use it
-        if 'AMBIENT_DEVICE_MAC' in os.environ:
-            amb = Ambient()
-            wa = amb.get_weather()
-            w.update(wa) # Ambient data will overlay Open Weather Maps data if it exists.
+        ambient = Ambient() if 'AMBIENT_DEVICE_MAC' in os.environ else None
 
-        logging.info("Weather data for display:")
-        logging.info(pformat(w))
-
-        # Initialize the display driver
+        # Display driver, initialized when the frame is pushed
         epd = epd7in5_V2.EPD()
-        epd.init()
-
-        # Generate a new weather display image
-        img = display.draw((epd.width, epd.height), w, f)
-
-        # Write out image to disk as a jpeg
-        img.save('display.jpg', "JPEG")
+        epd7in5_V2.epdconfig.configure_spi('epd7in5_V2')
+        if options.prometheus or options.metrics_log:
+            metrics.instrument(epd7in5_V2.epdconfig)
 
-        # Update e-paper display
-        update_display(img, epd)
+        store = FrameStore(options.frame_file)
+        # Pushes to the panel run here, one at a time, off the main thread.
+        # Give every panel its own worker when driving more than one.
+        panel = ThreadPoolExecutor(max_workers=1, thread_name_prefix='panel')
+        if options.daemon:
+            run_daemon(epd, openWeather, ambient, store, options, panel)
+        else:
+            refresh(epd, openWeather, ambient, store, options, panel).result()
+            panel.shutdown()
 
     except IOError as e:
         logging.info(e)
+
+    except epd7in5_V2.epdconfig.BusyTimeoutError as e:
+        logging.error(e)
+        epd7in5_V2.epdconfig.module_exit()
         
     except KeyboardInterrupt:    
         logging.info("ctrl + c:")
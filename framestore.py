@@ -0,0 +1,37 @@
+import os
+import json
+import logging
+
+# Keeps the last frame buffer pushed to the panel on disk so the next run can
+# diff against it, along with its hash and the number of partial refreshes
+# since the last full refresh.
+class FrameStore:
+    def __init__(self, path):
+        self.path = path
+
+    # Return (frame, partial_count, digest) or (None, 0, None) if nothing
+    # usable is stored
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                header = json.loads(f.readline())
+                frame = f.read()
+        except (OSError, ValueError) as e:
+            logging.debug(f"No previous frame: {e}")
+            return None, 0, None
+
+        if len(frame) != header.get('size'):
+            logging.warning(f"Discarding truncated frame file {self.path}")
+            return None, 0, None
+
+        return frame, header.get('partial_count', 0), header.get('hash')
+
+    def save(self, frame, partial_count, digest=None):
+        header = {'size': len(frame), 'partial_count': partial_count, 'hash': digest}
+
+        # write to a temp file and rename so a crash never leaves half a frame
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n')
+            f.write(bytes(frame))
+        os.replace(tmp, self.path)
@@ -0,0 +1,212 @@
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import PIL
+from PIL import Image,ImageDraw
+
+# Characters of the numbers, times and dates on the display
+GLYPHS = "0123456789-+.,:/|%° "
+
+# Strings checked when an atlas is built, on top of every pair of characters
+SAMPLES = ["  5° ", " 41° ", "-12°", "100°", "07:33 ", "02/03 ", "0.50 | 2.40 | 1.20 | 7.50 "]
+
+# Where built atlases are kept, shared with the API cache
+cache_dir = os.environ.get(
+    'FORECAST_CACHE_DIR', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache'))
+
+# Render text with font and return its ink as a bool array, with the text
+# origin at (pad, pad) and pad the font size
+def _ink(font, text, pad):
+    image = Image.new('1', ((len(text) + 3) * pad, 3 * pad), 0)
+    ImageDraw.Draw(image).text((pad, pad), text, font = font, fill = 1)
+    return np.array(image, dtype=bool)
+
+# 0, -1, 1, -2, 2 ... up to limit, the search order of corrections
+def _around_zero(limit):
+    return sorted(range(-limit, limit + 1), key=abs)
+
+# Pre-rendered glyphs of one font size, so numbers can be written by pasting
+# a bitmap per character instead of going through FreeType. Each glyph has
+# its ink, the ink's offset from the pen position and the advance to the next
+# character; kerning holds corrections for pairs that sit closer or further
+# apart, or None for pairs no whole pixel correction reproduces (FreeType
+# places glyphs at fractions of a pixel). Text with such a pair is left to
+# ImageDraw.text, and the atlas is not used at all (usable False) unless the
+# SAMPLES come out the same as ImageDraw.text when it is built.
+class GlyphAtlas:
+    def __init__(self, sprites, offsets, advances, kerning, usable):
+        self.sprites = sprites
+        self.offsets = offsets
+        self.advances = advances
+        self.kerning = kerning
+        self.usable = usable
+        self._arrays = {}
+
+    @classmethod
+    def build(cls, font, chars=GLYPHS):
+        pad = font.size
+        sprites, offsets = {}, {}
+        for c in chars:
+            ink = _ink(font, c, pad)
+            rows, cols = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+            if rows.size == 0:
+                sprites[c], offsets[c] = None, (0, 0)
+                continue
+            sprite = ink[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+            sprites[c] = Image.fromarray(sprite.astype(np.uint8) * 255).convert('1')
+            offsets[c] = (int(cols[0]) - pad, int(rows[0]) - pad)
+
+        atlas = cls(sprites, offsets, {}, {}, True)
+
+        # the advance of each character is where a reference glyph after it
+        # lands; a pair may be kerned, so try the next reference if none fits
+        refs = [c for c in chars if sprites[c] is not None]
+        for c in chars:
+            advance = None
+            for ref in refs:
+                advance = atlas._match(_ink(font, c + ref, pad), pad, c + ref, range(0, 2 * pad), 0)
+                if advance is not None:
+                    break
+            if advance is None:
+                logging.info(f"Glyph atlas for {font.path} {font.size} can't place '{c}', not used")
+                atlas.usable = False
+                return atlas
+            atlas.advances[c] = advance
+
+        # pairs that don't line up with plain advances get a kerning correction
+        for a in chars:
+            for b in chars:
+                if sprites[a] is None and sprites[b] is None:
+                    continue
+                kern = atlas._match(_ink(font, a + b, pad), pad, a + b, _around_zero(4), 0)
+                if kern is None:
+                    logging.debug(f"Glyph atlas for {font.path} {font.size} can't match '{a}{b}'")
+                if kern != 0:
+                    atlas.kerning[a + b] = kern
+
+        for text in SAMPLES:
+            if atlas.can_draw(text) and atlas._match(_ink(font, text, pad), pad, text, [0], None) is None:
+                logging.info(f"Glyph atlas for {font.path} {font.size} can't match '{text}', not used")
+                atlas.usable = False
+        return atlas
+
+    # Return the first value in candidates that, used as the advance of the
+    # character at index (None: use as is), composes text exactly as expected
+    def _match(self, expected, pad, text, candidates, index):
+        for candidate in candidates:
+            composed = np.zeros(expected.shape, dtype=bool)
+            if self._compose(composed, pad, text, index, candidate):
+                if np.array_equal(composed, expected):
+                    return candidate
+        return None
+
+    def _compose(self, ink, pad, text, index, adjust):
+        height, width = ink.shape
+        for c, x in zip(text, self._positions(text, index, adjust)):
+            if self.sprites[c] is None:
+                continue
+            ox, oy = self.offsets[c]
+            x0, y0 = pad + x + ox, pad + oy
+            if c not in self._arrays:
+                self._arrays[c] = np.array(self.sprites[c], dtype=bool)
+            sprite = self._arrays[c]
+            if x0 < 0 or y0 < 0 or x0 + sprite.shape[1] > width or y0 + sprite.shape[0] > height:
+                return False
+            ink[y0:y0 + sprite.shape[0], x0:x0 + sprite.shape[1]] |= sprite
+        return True
+
+    # Pen position of each character of text. adjust replaces the advance of
+    # the character at index while measuring advances, or is added to its
+    # kerning while measuring pairs.
+    def _positions(self, text, index=None, adjust=0):
+        pen = 0
+        positions = []
+        for i, c in enumerate(text):
+            positions.append(pen)
+            if i + 1 == len(text):
+                break
+            if index == i and c not in self.advances:
+                pen += adjust
+                continue
+            pen += self.advances[c] + (self.kerning.get(text[i:i + 2]) or 0)
+            if index == i:
+                pen += adjust
+        return positions
+
+    def can_draw(self, text):
+        return (self.usable and all(c in self.sprites for c in text)
+                and all(self.kerning.get(text[i:i + 2], 0) is not None for i in range(len(text) - 1)))
+
+    # Paste text with its origin at xy, like ImageDraw.text(xy, text, fill)
+    def draw(self, image, xy, text, fill=0):
+        x, y = xy
+        for c, pen in zip(text, self._positions(text)):
+            sprite = self.sprites[c]
+            if sprite is not None:
+                ox, oy = self.offsets[c]
+                x0, y0 = x + pen + ox, y + oy
+                image.paste(fill, (x0, y0, x0 + sprite.width, y0 + sprite.height), sprite)
+
+    # Store the atlas as a JSON header line with the glyph metrics followed by
+    # the packed 1 bit bitmaps
+    def save(self, path):
+        header = {
+            'usable': self.usable,
+            'glyphs': [
+                [c, self.offsets[c], self.advances.get(c),
+                 None if self.sprites[c] is None else list(self.sprites[c].size)]
+                for c in self.sprites],
+            'kerning': self.kerning,
+        }
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(header).encode() + b'\n')
+            for sprite in self.sprites.values():
+                if sprite is not None:
+                    f.write(sprite.tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            data = f.read()
+
+        sprites, offsets, advances = {}, {}, {}
+        pos = 0
+        for c, offset, advance, size in header['glyphs']:
+            offsets[c], advances[c] = tuple(offset), advance
+            sprites[c] = None
+            if size is not None:
+                length = (size[0] + 7) // 8 * size[1]
+                sprites[c] = Image.frombytes('1', tuple(size), data[pos:pos + length])
+                pos += length
+        return cls(sprites, offsets, advances, header['kerning'], header['usable'])
+
+# Return the atlas of font, loaded from the cache directory or built and
+# stored there. The file name covers the font file, size, characters and
+# Pillow version, so a change of any of them builds a new one.
+def get_atlas(font, chars=GLYPHS):
+    try:
+        mtime = os.path.getmtime(font.path)
+    except OSError:
+        mtime = 0
+    key = hashlib.sha1(json.dumps([font.path, mtime, font.size, chars, PIL.__version__]).encode()).hexdigest()
+    path = os.path.join(cache_dir, f"glyphs-{key}.bin")
+
+    try:
+        return GlyphAtlas.load(path)
+    except (OSError, ValueError, KeyError) as e:
+        logging.debug(f"No glyph atlas in {path}: {e}")
+
+    logging.info(f"Building glyph atlas for {os.path.basename(font.path)} {font.size}")
+    atlas = GlyphAtlas.build(font, chars)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        atlas.save(path)
+    except OSError as e:
+        logging.warning(f"Could not store glyph atlas {path}: {e}")
+    return atlas
@@ -30,6 +30,7 @@
 
 import logging
 from . import epdconfig
+from . import epdbuffer
 
 # Display resolution
 EPD_WIDTH       = 80
@@ -108,15 +109,16 @@ class EPD:
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
         
+    def send_data2(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
+
     def ReadBusy(self):
         logging.debug("e-Paper busy")
-        self.send_command(0x71)
-        busy = epdconfig.digital_read(self.busy_pin)
-        busy =not(busy & 0x01)
-        while(busy):
-            self.send_command(0x71)
-            busy = epdconfig.digital_read(self.busy_pin)
-            busy =not(busy & 0x01)
+        # the controller only updates BUSY after a get status command
+        epdconfig.wait_busy(self.busy_pin, 1, poll=lambda: self.send_command(0x71))      # 1: idle
         epdconfig.delay_ms(800)
         logging.debug("e-Paper busy release")        
 
@@ -237,26 +239,7 @@ class EPD:
         return 0
     
     def getbuffer(self, image):
-        buf = [0xFF] * (int(self.width / 8) * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        if(imwidth == self.width and imheight == self.height):
-            logging.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if pixels[x, y] == 0:
-                        buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-        elif(imwidth == self.height and imheight == self.width):
-            logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        buf[int((newx + newy*self.width) / 8)] &= ~(0x80 >> (y % 8))
-        return buf
+        return epdbuffer.pack_1bpp(image, self.width, self.height)
 
     def Display(self, image):
         if (image == None):
@@ -268,14 +251,10 @@ class EPD:
             Width = self.width / 8 + 1
             
         self.send_command(0x10)
-        for j in range(0, self.height):
-            for i in range(0, int(Width)):
-                self.send_data(0xff)  
+        self.send_data2([0xff] * int(Width * self.height))
         
         self.send_command(0x13)
-        for j in range(0, self.height):
-            for i in range(0, int(Width)):
-                self.send_data(image[i + j * int(Width)])  
+        self.send_data2(image)
         self.TurnOnDisplay()
         
     def Clear(self):
@@ -288,14 +267,10 @@ class EPD:
         Height = self.height
         
         self.send_command(0x10)
-        for j in range(0, Height):
-            for i in range(0, int(Width)):
-                self.send_data(0x00)  
+        self.send_data2([0x00] * int(Width * Height))
         
         self.send_command(0x13)
-        for j in range(0, Height):
-            for i in range(0, int(Width)):
-                self.send_data(0xff)  
+        self.send_data2([0xff] * int(Width * Height))
         self.TurnOnDisplay()
 
     def DisplayPartial(self, old_Image, Image):
@@ -310,23 +285,12 @@ class EPD:
         self.send_data(127)  #y-end
         self.send_data(0x00)
        
-        # Width = (self.width % 8 == 0)? (self.width / 8 ): (self.width / 8 + 1)
-        if(self.width % 8 == 0):
-            Width = self.width / 8
-        else:
-            Width = self.width / 8 + 1
-            
-        Height = self.height
         # send data
         self.send_command(0x10)
-        for j in range(0, Height):
-            for i in range(0, int(Width)):
-                self.send_data(old_Image[i + j * int(Width)])
+        self.send_data2(old_Image)
 
         self.send_command(0x13)
-        for j in range(0, Height):
-            for i in range(0, int(Width)):
-                self.send_data(Image[i + j * int(Width)])
+        self.send_data2(Image)
 
         # Set partial refresh
         self.TurnOnDisplay()
@@ -30,6 +30,7 @@
 
 import logging
 from . import epdconfig
+from . import epdbuffer
 
 # Display resolution
 EPD_WIDTH       = 640
@@ -73,8 +74,7 @@ class EPD:
         
     def ReadBusy(self):
         logging.debug("e-Paper busy")
-        while(epdconfig.digital_read(self.busy_pin) == 0):      # 0: idle, 1: busy
-            epdconfig.delay_ms(100)    
+        epdconfig.wait_busy(self.busy_pin, 1)      # 1: idle
         logging.debug("e-Paper busy release")
         
     def init(self):
@@ -125,9 +125,6 @@ class EPD:
     def getbuffer(self, image):
         img = image
         imwidth, imheight = img.size
-        halfwidth = int(self.width / 2)
-        buf = [0x33] * halfwidth * self.height
-        
         if(imwidth == self.width and imheight == self.height):
             img = img.convert('1')
         elif(imwidth == self.height and imheight == self.width):
@@ -136,25 +133,10 @@ class EPD:
         else:
             logging.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
             # return a blank buffer
-            return buf
-        
-        pixels = img.load()
+            return bytearray([0x33]) * int(self.width / 2 * self.height)
 
-        for y in range(imheight):
-            offset = y * halfwidth
-            for x in range(1, imwidth, 2):
-                i = offset + x // 2
-                if(pixels[x-1, y] > 191):
-                    if(pixels[x, y] > 191):
-                        buf[i] = 0x33
-                    else:
-                        buf[i] = 0x30
-                else:
-                    if(pixels[x, y] > 191):
-                        buf[i] = 0x03
-                    else:
-                        buf[i] = 0x00
-        return buf
+        # 4 bits per pixel: black = 0x0, white = 0x3
+        return epdbuffer.widen(epdbuffer.pack_1bpp(img, self.width, self.height), 4, 0x3)
         
     def display(self, image):
         self.send_command(0x10)
@@ -30,6 +30,7 @@
 
 import logging
 from . import epdconfig
+from . import epdbuffer
 
 # Display resolution
 EPD_WIDTH       = 880
@@ -73,9 +74,7 @@ class EPD:
         
     def ReadBusy(self):
         logging.debug("e-Paper busy")
-        busy = epdconfig.digital_read(self.busy_pin)
-        while(busy == 1):
-            busy = epdconfig.digital_read(self.busy_pin)
+        epdconfig.wait_busy(self.busy_pin, 0)      # 0: idle
         epdconfig.delay_ms(200)
         
     def init(self):
@@ -138,10 +137,9 @@ class EPD:
         else:
             logging.warning("Wrong image dimensions: must be " + str(self.width) + "x" + str(self.height))
             # return a blank buffer
-            return [0xff] * int(self.width * self.height / 8)
+            return bytearray([0xff]) * int(self.width * self.height / 8)
 
-        buf = bytearray(img.tobytes('raw'))
-        return buf
+        return epdbuffer.pack_1bpp(img, self.width, self.height)
         
     def display(self, image):
         self.send_command(0x4F); 
@@ -30,6 +30,7 @@
 
 import logging
 from . import epdconfig
+from . import epdbuffer
 
 # Display resolution
 EPD_WIDTH       = 800
@@ -65,13 +66,16 @@ class EPD:
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
         
+    def send_data2(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
+
     def ReadBusy(self):
         logging.debug("e-Paper busy")
-        self.send_command(0x71)
-        busy = epdconfig.digital_read(self.busy_pin)
-        while(busy == 0):
-            self.send_command(0x71)
-            busy = epdconfig.digital_read(self.busy_pin)
+        # the controller only updates BUSY after a get status command
+        epdconfig.wait_busy(self.busy_pin, 1, poll=lambda: self.send_command(0x71))      # 1: idle
         epdconfig.delay_ms(200)
         
     def init(self):
@@ -112,47 +116,70 @@ class EPD:
         # EPD hardware init end
         return 0
 
+    def init_part(self):
+        if (self.init() != 0):
+            return -1
+
+        self.send_command(0xE0)         #CASCADE SETTING
+        self.send_data(0x02)
+        self.send_command(0xE5)         #FORCE TEMPERATURE, selects the fast waveform
+        self.send_data(0x6E)
+        return 0
+
     def getbuffer(self, image):
-        # logging.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width/8) * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        # logging.debug("imwidth = %d, imheight = %d",imwidth,imheight)
-        if(imwidth == self.width and imheight == self.height):
-            logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if pixels[x, y] == 0:
-                        buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-        elif(imwidth == self.height and imheight == self.width):
-            logging.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        buf[int((newx + newy*self.width) / 8)] &= ~(0x80 >> (y % 8))
-        return buf
+        return epdbuffer.pack_1bpp(image, self.width, self.height)
         
     def display(self, image):
         self.send_command(0x13)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(~image[i])
+        self.send_data2(epdbuffer.invert(image))
                 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
         self.ReadBusy()
         
+    # Refresh only the window x_start..x_end, y_start..y_end of a full frame
+    # buffer. Ends are exclusive and x must be on byte boundaries. previous is
+    # the frame the panel shows now; its window goes to the old data RAM so
+    # the waveform only drives the pixels that change.
+    def display_Partial(self, image, x_start, y_start, x_end, y_end, previous=None):
+        self.send_command(0X50)			#VCOM AND DATA INTERVAL SETTING
+        self.send_data(0xA9)
+        self.send_data(0x07)
+
+        self.send_command(0x91)         #PARTIAL IN
+        self.send_command(0x90)         #PARTIAL WINDOW
+        self.send_data(x_start // 256)
+        self.send_data(x_start % 256)
+        self.send_data((x_end - 1) // 256)
+        self.send_data((x_end - 1) % 256)
+        self.send_data(y_start // 256)
+        self.send_data(y_start % 256)
+        self.send_data((y_end - 1) // 256)
+        self.send_data((y_end - 1) % 256)
+        self.send_data(0x01)            #scan inside and outside the window
+
+        linewidth = int(self.width / 8)
+        if previous is not None:
+            buf = epdbuffer.window(previous, linewidth, x_start // 8, y_start, x_end // 8, y_end)
+            self.send_command(0x10)
+            self.send_data2(epdbuffer.invert(buf))
+
+        buf = epdbuffer.window(image, linewidth, x_start // 8, y_start, x_end // 8, y_end)
+        self.send_command(0x13)
+        self.send_data2(epdbuffer.invert(buf))
+
+        self.send_command(0x12)
+        epdconfig.delay_ms(100)
+        self.ReadBusy()
+
+        self.send_command(0x92)         #PARTIAL OUT
+
     def Clear(self):
         self.send_command(0x10)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0x00)
+        self.send_data2([0x00] * int(self.width * self.height / 8))
             
         self.send_command(0x13)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0x00)
+        self.send_data2([0x00] * int(self.width * self.height / 8))
                 
         self.send_command(0x12)
         epdconfig.delay_ms(100)
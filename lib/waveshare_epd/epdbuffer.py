@@ -0,0 +1,241 @@
+# *****************************************************************************
+# * | File        :	  epdbuffer.py
+# * | Function    :   Frame buffer packing shared by the e-paper drivers
+# * | Info        :
+# *----------------
+# * | Info        :   Converts PIL images into the byte layout expected by the
+# * |             :   panel controllers with bulk numpy operations instead of
+# * |             :   per pixel Python loops.
+# ******************************************************************************
+
+import hashlib
+import logging
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+# Return the image as 'mode' ('1' by default) in panel orientation. Images
+# given in the rotated (height x width) orientation are turned 90 degrees
+# counter clockwise, which is where the drivers have always put them. Returns
+# None when the image matches neither orientation.
+def orient(image, width, height, rotated=Image.ROTATE_90, mode='1'):
+    imwidth, imheight = image.size
+    if(imwidth == width and imheight == height):
+        logging.debug("Vertical")
+        return image.convert(mode)
+    elif(imwidth == height and imheight == width):
+        logging.debug("Horizontal")
+        return image.convert(mode).transpose(rotated)
+    return None
+
+# Pack an image into a 1 bit per pixel buffer, MSB first, 1 = white. Rows are
+# padded to whole bytes with white bits. mirror lays upright rows out right to
+# left starting at bit 1 and takes rotated images as a plain transpose, which
+# is how epd2in13_V2 addresses its RAM.
+def pack_1bpp(image, width, height, mirror=False):
+    linewidth = (width + 7) // 8
+
+    img = orient(image, width, height, Image.TRANSPOSE if mirror else Image.ROTATE_90)
+    if img is None:
+        return bytearray([0xFF]) * (linewidth * height)
+    mirror = mirror and image.size == (width, height)
+
+    raw = img.tobytes('raw')
+    if width % 8 == 0 and not mirror:
+        # PIL already stores mode '1' rows in the panel layout
+        return bytearray(raw)
+
+    bits = np.unpackbits(np.frombuffer(raw, dtype=np.uint8).reshape(height, -1), axis=1)[:, :width]
+    line = np.ones((height, linewidth * 8), dtype=np.uint8)
+    if mirror:
+        line[:, width:0:-1] = bits
+    else:
+        line[:, :width] = bits
+    return bytearray(np.packbits(line, axis=1).tobytes())
+
+# Split one color image into the black and the red (or yellow) 1 bpp planes
+# of the tri-color panels in a single pass. Every pixel goes to the nearest of
+# black, white and 'color'; each plane has 0 where its ink goes, the same
+# layout pack_1bpp gives for the two separate images.
+def split_planes(image, width, height, color=(255, 0, 0)):
+    linewidth = (width + 7) // 8
+
+    img = orient(image, width, height, mode='RGB')
+    if img is None:
+        blank = bytearray([0xFF]) * (linewidth * height)
+        return blank, bytearray(blank)
+
+    codes = _nearest(np.asarray(img), np.array([(0, 0, 0), (255, 255, 255), color], dtype=np.int32))
+    line = np.ones((2, height, linewidth * 8), dtype=np.uint8)
+    line[0, :, :width] = codes != 0
+    line[1, :, :width] = codes != 2
+    planes = np.packbits(line, axis=2)
+    return bytearray(planes[0].tobytes()), bytearray(planes[1].tobytes())
+
+# Lookup table expanding one packed 1 bpp byte into 'bits' bytes where every
+# white pixel becomes the field value 'white' and every black pixel 0.
+@lru_cache(maxsize=None)
+def _widen_table(bits, white):
+    pixels = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.uint16) * white
+    per_byte = 8 // bits
+    shifts = np.arange(per_byte - 1, -1, -1, dtype=np.uint16) * bits
+    fields = pixels.reshape(256, bits, per_byte) << shifts
+    return fields.sum(axis=2).astype(np.uint8)
+
+# Convert a 1 bpp buffer into a 2 or 4 bpp buffer for controllers that take
+# several bits per pixel even in black and white mode.
+def widen(buf, bits, white):
+    table = _widen_table(bits, white)
+    return bytearray(table[np.frombuffer(bytes(buf), dtype=np.uint8)].tobytes())
+
+# Join per pixel 4 bit codes into bytes, two pixels per byte, left pixel in
+# the high nibble.
+def _join_nibbles(codes):
+    codes = codes.astype(np.uint8).reshape(-1, 2)
+    return ((codes[:, 0] << 4) | codes[:, 1]).tobytes()
+
+# Merge a black and a red 1 bpp plane into the 4 bpp format of the UC8159
+# based panels: 0x0 black, 0x3 white, 0x4 red. Red wins where both are set.
+def merge_planes(black, red):
+    black = np.unpackbits(np.frombuffer(bytes(black), dtype=np.uint8))
+    red = np.unpackbits(np.frombuffer(bytes(red), dtype=np.uint8))
+    return _join_nibbles(np.where(red == 0, 0x4, np.where(black == 0, 0x0, 0x3)))
+
+# Convert a 2 bpp buffer (00 black, 11 white, anything else red) into the
+# same 4 bpp format.
+def regroup_2bpp(buf):
+    pixels = np.frombuffer(bytes(buf), dtype=np.uint8)
+    codes = np.stack([pixels >> 6, pixels >> 4, pixels >> 2, pixels], axis=1).reshape(-1) & 0x3
+    return _join_nibbles(np.where(codes == 0x3, 0x3, np.where(codes == 0x0, 0x0, 0x4)))
+
+# 2 bit gray code, 0 black to 3 white, for every 'L' level. The 4 gray
+# palette is 0x00, 0x80, 0xC0, 0xFF; any other level gets the code of its top
+# two bits.
+def _gray_codes():
+    levels = np.arange(256, dtype=np.uint8)
+    levels = np.where(levels == 0xC0, 0x80, np.where(levels == 0x80, 0x40, levels))
+    return (levels >> 6).astype(np.uint8)
+
+_GRAY_CODES = _gray_codes()
+
+# Quantize an image to the 4 gray levels and pack it 2 bits per pixel, MSB
+# first, in panel orientation. transpose takes rotated images as a plain
+# transpose instead of a 90 degree turn, as epd2in7 and epd4in2 do.
+def pack_2bpp_gray(image, width, height, transpose=False):
+    img = orient(image, width, height, Image.TRANSPOSE if transpose else Image.ROTATE_90, 'L')
+    if img is None:
+        return bytearray([0xFF]) * (width // 4 * height)
+
+    codes = _GRAY_CODES[np.asarray(img)].reshape(-1, 4)
+    return bytearray(((codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]).tobytes())
+
+# Split a 2 bpp gray buffer into the two 1 bpp planes the controllers load
+# into their old and new data RAM: the high bit of every gray code (white and
+# gray1 set) and the low bit (white and gray2 set).
+def gray_planes(buf):
+    pixels = np.frombuffer(bytes(buf), dtype=np.uint8)
+    codes = np.stack([pixels >> 6, pixels >> 4, pixels >> 2, pixels], axis=1) & 0x3
+    return np.packbits(codes >> 1).tobytes(), np.packbits(codes & 0x1).tobytes()
+
+# The 7 color ACeP palette in controller color index order: black, white,
+# green, blue, red, yellow, orange
+PALETTE_7COLOR = np.array([
+    (0, 0, 0), (255, 255, 255), (0, 255, 0), (0, 0, 255),
+    (255, 0, 0), (255, 255, 0), (255, 128, 0)], dtype=np.int32)
+
+# 4x4 Bayer matrix as thresholds centered on 0, in 0..1 units
+_BAYER_4X4 = (np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5]]) + 0.5) / 16 - 0.5
+
+# Index of the nearest palette color for every pixel of an RGB array
+def _nearest(rgb, palette):
+    rgb = rgb.astype(np.int32)
+    dist = np.zeros(rgb.shape[:2] + (len(palette),), dtype=np.int32)
+    for i, color in enumerate(palette):
+        dist[..., i] = ((rgb - color) ** 2).sum(axis=2)
+    return dist.argmin(axis=2).astype(np.uint8)
+
+# Quantize an image to a color palette and pack it 4 bits per pixel, left
+# pixel in the high nibble, in panel orientation. dither is None for the
+# nearest color, 'ordered' for a Bayer pattern or 'diffusion' for Floyd
+# Steinberg error diffusion. Images of the wrong size give an all black
+# frame.
+def pack_4bpp_color(image, width, height, palette=PALETTE_7COLOR, dither=None):
+    img = orient(image, width, height, mode='RGB')
+    if img is None:
+        return bytes(width // 2 * height)
+
+    if dither == 'diffusion':
+        # PIL diffuses the error in C; its palette is padded to 256 entries
+        # with black, which folds back onto index 0
+        pal = Image.new('P', (1, 1))
+        pal.putpalette(palette.astype(np.uint8).tobytes() + bytes(3 * (256 - len(palette))))
+        codes = np.asarray(img.quantize(palette=pal)).copy()
+        codes[codes >= len(palette)] = 0
+    elif dither == 'ordered':
+        # offset each channel by up to half the 128 step between palette levels
+        rgb = np.asarray(img).astype(np.float32)
+        bayer = np.tile(_BAYER_4X4, (height // 4 + 1, width // 4 + 1))[:height, :width]
+        rgb += bayer[..., None] * 128
+        codes = _nearest(np.clip(rgb, 0, 255), palette)
+    elif dither is None:
+        codes = _nearest(np.asarray(img), palette)
+    else:
+        raise ValueError(f"unknown dither mode: {dither}")
+
+    codes = codes.reshape(-1, 2)
+    return ((codes[:, 0] << 4) | codes[:, 1]).tobytes()
+
+# Return the rows y0..y1 and byte columns x0..x1 (end exclusive) of a buffer
+# with linewidth bytes per row, for the partial window commands.
+def window(buf, linewidth, x0, y0, x1, y1):
+    rows = np.frombuffer(bytes(buf), dtype=np.uint8).reshape(-1, linewidth)
+    return rows[y0:y1, x0:x1].tobytes()
+
+# Find the regions that differ between two frames with linewidth bytes per
+# row. Changed rows closer than 'gap' rows are grouped into one band and each
+# band is narrowed to its changed byte columns. Returns a list of
+# (x_start, y_start, x_end, y_end) pixel boxes, ends exclusive.
+def dirty_boxes(old, new, linewidth, gap=8):
+    old = np.frombuffer(bytes(old), dtype=np.uint8).reshape(-1, linewidth)
+    new = np.frombuffer(bytes(new), dtype=np.uint8).reshape(-1, linewidth)
+    diff = old != new
+
+    rows = np.flatnonzero(diff.any(axis=1))
+    if rows.size == 0:
+        return []
+
+    boxes = []
+    for band in np.split(rows, np.flatnonzero(np.diff(rows) > gap) + 1):
+        y_start, y_end = int(band[0]), int(band[-1]) + 1
+        cols = np.flatnonzero(diff[y_start:y_end].any(axis=0))
+        boxes.append((int(cols[0]) * 8, y_start, (int(cols[-1]) + 1) * 8, y_end))
+    return boxes
+
+# Merge pixel boxes into the one box that covers them all, so the panel runs
+# a single partial refresh rather than one per box.
+def bounding_box(boxes):
+    x0, y0, x1, y1 = zip(*boxes)
+    return (min(x0), min(y0), max(x1), max(y1))
+
+# Hash a frame with linewidth bytes per row to tell whether it changed. The
+# pixel boxes in exclude, (x_start, y_start, x_end, y_end) with ends exclusive,
+# are blanked first so content that changes on every run (a clock) doesn't
+# count. x is widened to whole bytes.
+def frame_hash(buf, linewidth, exclude=()):
+    if exclude:
+        rows = np.frombuffer(bytes(buf), dtype=np.uint8).reshape(-1, linewidth).copy()
+        for x0, y0, x1, y1 in exclude:
+            rows[y0:y1, x0 // 8:(x1 + 7) // 8] = 0
+        buf = rows
+    return hashlib.sha1(bytes(buf)).hexdigest()
+
+# Invert every byte of a buffer, the bulk form of sending ~buf[i] byte by byte.
+def invert(buf):
+    return np.bitwise_xor(np.frombuffer(bytes(buf), dtype=np.uint8), 0xFF).tobytes()
+
+### END OF FILE ###
@@ -28,10 +28,118 @@
 #
 
 import os
+import json
 import logging
 import sys
+import threading
 import time
 
+# Seconds to wait for the panel to release BUSY before giving up. The
+# slowest panels (7 color ACeP) need around 30 s for a full refresh.
+BUSY_TIMEOUT = 60
+
+# Seconds between the poll calls of wait_busy, for controllers that only
+# update BUSY after a get status command (0x71 on the UC81xx)
+BUSY_POLL = 0.02
+
+
+class BusyTimeoutError(RuntimeError):
+    pass
+
+
+# SPI settings per panel model, by driver module name, on top of 'default'.
+# EPD_SPI adds to these with JSON of the same shape, e.g.
+#   EPD_SPI='{"default": {"speed_hz": 8000000}, "epd7in5_HD": {"speed_hz": 16000000}}'
+# speed_hz is the clock, mode the SPI mode and chunk_size the most bytes sent
+# in one transfer; larger writes are split. chunk_size None uses the spidev
+# buffer size.
+SPI_SETTINGS = {
+    'default': {'speed_hz': 4000000, 'mode': 0, 'chunk_size': None},
+}
+
+# Clock rates tried by calibrate_spi, slowest first
+SPI_SPEEDS = [2000000, 4000000, 8000000, 10000000, 16000000, 20000000, 32000000]
+
+
+# Largest transfer spidev accepts, the spidev.bufsiz kernel parameter (4096
+# unless raised on the kernel command line)
+def _spidev_bufsiz():
+    try:
+        with open('/sys/module/spidev/parameters/bufsiz') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 4096
+
+
+# Return the SPI settings for a panel model, or the defaults with no model
+def spi_settings(model=None):
+    config = json.loads(os.environ.get('EPD_SPI', '{}'))
+    settings = dict(SPI_SETTINGS['default'])
+    settings.update(config.get('default', {}))
+    if model is not None:
+        settings.update(SPI_SETTINGS.get(model, {}))
+        settings.update(config.get(model, {}))
+    if settings['chunk_size'] is None:
+        settings['chunk_size'] = _spidev_bufsiz()
+    return settings
+
+
+# Wait until the BUSY pin reads 'idle'. Sleeps on a GPIO edge interrupt so the
+# CPU is free while the panel refreshes, and falls back to polling with an
+# increasing delay when edge detection is not available for the pin. poll, if
+# given, is called before every read of the pin, at least every BUSY_POLL
+# seconds.
+def _wait_busy(gpio, pin, idle, timeout, poll=None):
+    if poll is not None:
+        poll()
+    if gpio.input(pin) == idle:
+        return
+
+    released = threading.Event()
+    try:
+        gpio.add_event_detect(pin, gpio.RISING if idle else gpio.FALLING,
+                              callback=lambda channel: released.set())
+    except (RuntimeError, ValueError) as e:
+        logging.debug("edge detection unavailable, polling BUSY: %s", e)
+        _poll_busy(gpio, pin, idle, timeout, poll)
+        return
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    try:
+        while True:
+            released.clear()
+            if poll is not None:
+                poll()
+            if gpio.input(pin) == idle:
+                break
+            remaining = 1.0 if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                raise BusyTimeoutError("e-Paper busy for more than %s s" % timeout)
+            # re-check the level at least every second in case an edge is missed
+            released.wait(min(remaining, _recheck(poll)))
+    finally:
+        gpio.remove_event_detect(pin)
+
+
+def _poll_busy(gpio, pin, idle, timeout, poll=None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        if poll is not None:
+            poll()
+        if gpio.input(pin) == idle:
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            raise BusyTimeoutError("e-Paper busy for more than %s s" % timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, _recheck(poll, 0.1))
+
+
+# Longest sleep between two reads of BUSY while waiting for an edge
+def _recheck(poll, longest=1.0):
+    return longest if poll is None else min(longest, BUSY_POLL)
+
 
 class RaspberryPi:
     # Pin definition
@@ -48,6 +156,10 @@ class RaspberryPi:
 
         # SPI device, bus = 0, device = 0
         self.SPI = spidev.SpiDev(0, 0)
+        settings = spi_settings()
+        self.speed_hz = settings['speed_hz']
+        self.spi_mode = settings['mode']
+        self.chunk_size = settings['chunk_size']
 
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
@@ -58,11 +170,23 @@ class RaspberryPi:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_busy(self, pin, idle, timeout=BUSY_TIMEOUT, poll=None):
+        _wait_busy(self.GPIO, pin, idle, timeout, poll)
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
-        self.SPI.writebytes2(data)
+        for i in range(0, len(data), self.chunk_size):
+            self.SPI.writebytes2(data[i:i + self.chunk_size])
+
+    # Send data and return what was read back at the same time, for
+    # calibrate_spi with MOSI wired to MISO
+    def spi_loopback(self, data):
+        received = bytearray()
+        for i in range(0, len(data), self.chunk_size):
+            received += bytes(self.SPI.xfer2(list(data[i:i + self.chunk_size])))
+        return bytes(received)
 
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
@@ -71,8 +195,8 @@ class RaspberryPi:
         self.GPIO.setup(self.DC_PIN, self.GPIO.OUT)
         self.GPIO.setup(self.CS_PIN, self.GPIO.OUT)
         self.GPIO.setup(self.BUSY_PIN, self.GPIO.IN)
-        self.SPI.max_speed_hz = 4000000
-        self.SPI.mode = 0b00
+        self.SPI.max_speed_hz = self.speed_hz
+        self.SPI.mode = self.spi_mode
         return 0
 
     def module_exit(self):
@@ -121,9 +245,16 @@ class JetsonNano:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_busy(self, pin, idle, timeout=BUSY_TIMEOUT, poll=None):
+        _wait_busy(self.GPIO, self.BUSY_PIN, idle, timeout, poll)
+
     def spi_writebyte(self, data):
         self.SPI.SYSFS_software_spi_transfer(data[0])
 
+    def spi_writebyte2(self, data):
+        for byte in data:
+            self.SPI.SYSFS_software_spi_transfer(byte)
+
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
@@ -145,13 +276,445 @@ class JetsonNano:
         self.GPIO.cleanup()
 
 
-if os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835'):
-    implementation = RaspberryPi()
-else:
-    implementation = JetsonNano()
+# Raspberry Pi with the chip select left to the kernel: spidev asserts CE0
+# for each transfer, so the drivers' CS toggles cost nothing, and DC is only
+# written when its level changes. CE0 (GPIO 8) must still be in its SPI
+# function, i.e. not claimed as an output since boot (or restored with
+# `raspi-gpio set 8 a0`).
+class RaspberryPiHardwareCS(RaspberryPi):
+    def __init__(self):
+        super().__init__()
+        self._levels = {}
+
+    def digital_write(self, pin, value):
+        if pin == self.CS_PIN or self._levels.get(pin) == value:
+            return
+        self._levels[pin] = value
+        self.GPIO.output(pin, value)
+
+    def module_init(self):
+        self._levels.clear()
+        self.GPIO.setmode(self.GPIO.BCM)
+        self.GPIO.setwarnings(False)
+        self.GPIO.setup(self.RST_PIN, self.GPIO.OUT)
+        self.GPIO.setup(self.DC_PIN, self.GPIO.OUT)
+        self.GPIO.setup(self.BUSY_PIN, self.GPIO.IN)
+        self.SPI.max_speed_hz = self.speed_hz
+        self.SPI.mode = self.spi_mode
+        return 0
+
+
+# GPIO through the libgpiod (v2) character device, SPI through spidev with
+# hardware chip select. BUSY is waited on with the kernel's edge events.
+# EPD_GPIOCHIP picks the chip, /dev/gpiochip0 by default.
+class LibGpiod:
+    # Pin definition
+    RST_PIN         = 17
+    DC_PIN          = 25
+    CS_PIN          = 8
+    BUSY_PIN        = 24
+
+    def __init__(self):
+        import gpiod
+        import spidev
+        from gpiod.line import Direction, Edge, Value
+
+        self.gpiod = gpiod
+        self.spidev = spidev
+        self.Direction, self.Edge, self.Value = Direction, Edge, Value
+        self.chip = os.environ.get('EPD_GPIOCHIP', '/dev/gpiochip0')
+
+        settings = spi_settings()
+        self.speed_hz = settings['speed_hz']
+        self.spi_mode = settings['mode']
+        self.chunk_size = settings['chunk_size']
+
+        self.lines = None
+        self.SPI = None
+        self._levels = {}
+
+    def digital_write(self, pin, value):
+        if pin == self.CS_PIN or self._levels.get(pin) == value:
+            return
+        self._levels[pin] = value
+        self.lines.set_value(pin, self.Value.ACTIVE if value else self.Value.INACTIVE)
+
+    def digital_read(self, pin):
+        return int(self.lines.get_value(pin) == self.Value.ACTIVE)
+
+    def delay_ms(self, delaytime):
+        time.sleep(delaytime / 1000.0)
+
+    def wait_busy(self, pin, idle, timeout=BUSY_TIMEOUT, poll=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # drop queued edges before reading the level so none is missed
+            while self.lines.wait_edge_events(0):
+                self.lines.read_edge_events()
+            if poll is not None:
+                poll()
+            if self.digital_read(pin) == idle:
+                return
+            remaining = 1.0 if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                raise BusyTimeoutError("e-Paper busy for more than %s s" % timeout)
+            self.lines.wait_edge_events(min(remaining, _recheck(poll)))
+
+    def spi_writebyte(self, data):
+        self.SPI.writebytes(data)
+
+    def spi_writebyte2(self, data):
+        for i in range(0, len(data), self.chunk_size):
+            self.SPI.writebytes2(data[i:i + self.chunk_size])
+
+    # Send data and return what was read back at the same time, for
+    # calibrate_spi with MOSI wired to MISO
+    def spi_loopback(self, data):
+        received = bytearray()
+        for i in range(0, len(data), self.chunk_size):
+            received += bytes(self.SPI.xfer2(list(data[i:i + self.chunk_size])))
+        return bytes(received)
+
+    def module_init(self):
+        if self.lines is None:
+            self.lines = self.gpiod.request_lines(self.chip, consumer='waveshare_epd', config={
+                (self.RST_PIN, self.DC_PIN): self.gpiod.LineSettings(direction=self.Direction.OUTPUT),
+                self.BUSY_PIN: self.gpiod.LineSettings(direction=self.Direction.INPUT, edge_detection=self.Edge.BOTH),
+            })
+            self._levels.clear()
+        if self.SPI is None:
+            self.SPI = self.spidev.SpiDev(0, 0)
+        self.SPI.max_speed_hz = self.speed_hz
+        self.SPI.mode = self.spi_mode
+        return 0
+
+    def module_exit(self):
+        logging.debug("spi end")
+        if self.SPI is not None:
+            self.SPI.close()
+            self.SPI = None
+
+        logging.debug("close 5V, Module enters 0 power consumption ...")
+        if self.lines is not None:
+            self.digital_write(self.RST_PIN, 0)
+            self.digital_write(self.DC_PIN, 0)
+            self.lines.release()
+            self.lines = None
+
+
+# GPIO and SPI through the pigpio daemon (start it with `sudo pigpiod`). Every
+# call is a round trip to the daemon, so pin writes that don't change the
+# level are skipped and chip select is left to pigpio's SPI.
+class Pigpio:
+    # Pin definition
+    RST_PIN         = 17
+    DC_PIN          = 25
+    CS_PIN          = 8
+    BUSY_PIN        = 24
+
+    def __init__(self):
+        import pigpio
+
+        self.pigpio = pigpio
+        settings = spi_settings()
+        self.speed_hz = settings['speed_hz']
+        self.spi_mode = settings['mode']
+        self.chunk_size = settings['chunk_size']
+
+        self.pi = None
+        self.SPI = None
+        self._spi_open_args = None
+        self._levels = {}
+
+    def digital_write(self, pin, value):
+        if pin == self.CS_PIN or self._levels.get(pin) == value:
+            return
+        self._levels[pin] = value
+        self.pi.write(pin, value)
+
+    def digital_read(self, pin):
+        return self.pi.read(pin)
+
+    def delay_ms(self, delaytime):
+        time.sleep(delaytime / 1000.0)
+
+    def wait_busy(self, pin, idle, timeout=BUSY_TIMEOUT, poll=None):
+        edge = self.pigpio.RISING_EDGE if idle else self.pigpio.FALLING_EDGE
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if poll is not None:
+                poll()
+            if self.pi.read(pin) == idle:
+                return
+            remaining = 1.0 if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                raise BusyTimeoutError("e-Paper busy for more than %s s" % timeout)
+            # re-check the level at least every second in case an edge is missed
+            self.pi.wait_for_edge(pin, edge, min(remaining, _recheck(poll)))
+
+    def spi_writebyte(self, data):
+        self.pi.spi_write(self.SPI, data)
+
+    def spi_writebyte2(self, data):
+        for i in range(0, len(data), self.chunk_size):
+            self.pi.spi_write(self.SPI, data[i:i + self.chunk_size])
+
+    def spi_loopback(self, data):
+        received = bytearray()
+        for i in range(0, len(data), self.chunk_size):
+            count, rx = self.pi.spi_xfer(self.SPI, data[i:i + self.chunk_size])
+            received += rx
+        return bytes(received)
+
+    def module_init(self):
+        if self.pi is None:
+            pi = self.pigpio.pi()
+            if not pi.connected:
+                raise RuntimeError('Cannot connect to the pigpio daemon')
+            self.pi = pi
+            self._levels.clear()
+        self.pi.set_mode(self.RST_PIN, self.pigpio.OUTPUT)
+        self.pi.set_mode(self.DC_PIN, self.pigpio.OUTPUT)
+        self.pi.set_mode(self.BUSY_PIN, self.pigpio.INPUT)
+        # pigpio takes the clock and mode when the device is opened
+        if self.SPI is not None and self._spi_open_args != (self.speed_hz, self.spi_mode):
+            self.pi.spi_close(self.SPI)
+            self.SPI = None
+        if self.SPI is None:
+            self._spi_open_args = (self.speed_hz, self.spi_mode)
+            self.SPI = self.pi.spi_open(0, self.speed_hz, self.spi_mode)
+        return 0
+
+    def module_exit(self):
+        logging.debug("spi end")
+        if self.SPI is not None:
+            self.pi.spi_close(self.SPI)
+            self.SPI = None
+
+        logging.debug("close 5V, Module enters 0 power consumption ...")
+        if self.pi is not None:
+            self.digital_write(self.RST_PIN, 0)
+            self.digital_write(self.DC_PIN, 0)
+            self.pi.stop()
+            self.pi = None
+
+
+# Stands in for the panel and its interface on machines without one. Every
+# command and data byte is captured, BUSY is simulated from a per command
+# timing model and the last data written to each RAM command can be turned
+# back into an image. Time is simulated: delays, BUSY waits and SPI transfers
+# (at speed_hz) add to stats['elapsed'] without sleeping unless realtime is
+# set. EPD_VIRTUAL_SPI_LIMIT sets a clock above which spi_loopback corrupts
+# data, to try calibrate_spi against.
+class Virtual:
+    # Pin definition
+    RST_PIN         = 17
+    DC_PIN          = 25
+    CS_PIN          = 8
+    BUSY_PIN        = 24
+
+    # Seconds BUSY stays asserted after each command. 0x12 (UC81xx display
+    # refresh) and 0x20 (SSD16xx master activation) start a refresh, 0x04
+    # and 0x02 power the panel on and off.
+    BUSY_MODEL = {0x12: 3.0, 0x20: 3.0, 0x04: 0.05, 0x02: 0.05}
+
+    def __init__(self):
+        self.busy_model = dict(self.BUSY_MODEL)
+        self.busy_model.update({
+            int(command, 0): seconds
+            for command, seconds in json.loads(os.environ.get('EPD_VIRTUAL_BUSY', '{}')).items()})
+        self.realtime = os.environ.get('EPD_VIRTUAL_REALTIME', '0') == '1'
+        self.spi_limit = int(os.environ.get('EPD_VIRTUAL_SPI_LIMIT', '0')) or None
+        settings = spi_settings()
+        self.speed_hz = settings['speed_hz']
+        self.spi_mode = settings['mode']
+        self.chunk_size = settings['chunk_size']
+
+        self.pins = {self.RST_PIN: 0, self.DC_PIN: 0, self.CS_PIN: 1}
+        # [[is_data, bytearray], ...] in the order sent, consecutive data merged
+        self.transactions = []
+        # command -> the data bytes that followed it the last time it was sent
+        self.ram = {}
+        self.stats = {}
+        self.clear_capture()
+
+    # Forget everything captured so far and restart the simulated clock
+    def clear_capture(self):
+        self.transactions.clear()
+        self.ram.clear()
+        self.stats.clear()
+        self.stats.update(commands=0, data_bytes=0, transfers=0,
+                          spi_time=0.0, busy_time=0.0, delay_time=0.0, elapsed=0.0)
+        self._busy_until = 0.0
+        self._busy_idle = 1
+        self._command = None
+
+    def _advance(self, seconds, stat):
+        self.stats['elapsed'] += seconds
+        self.stats[stat] += seconds
+        if self.realtime:
+            time.sleep(seconds)
+
+    def _write(self, data):
+        data = bytes(data)
+        self.stats['transfers'] += 1
+        self._advance(len(data) * 8 / self.speed_hz, 'spi_time')
+
+        if not self.pins[self.DC_PIN]:
+            for command in data:
+                self.stats['commands'] += 1
+                self.transactions.append([False, bytearray([command])])
+                self._command = command
+                self.ram[command] = bytearray()
+                if command in self.busy_model:
+                    self._busy_until = self.stats['elapsed'] + self.busy_model[command]
+            return
+
+        self.stats['data_bytes'] += len(data)
+        if self.transactions and self.transactions[-1][0]:
+            self.transactions[-1][1] += data
+        else:
+            self.transactions.append([True, bytearray(data)])
+        if self._command is not None:
+            self.ram[self._command] += data
+
+    def digital_write(self, pin, value):
+        self.pins[pin] = value
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN:
+            busy = self.stats['elapsed'] < self._busy_until
+            return self._busy_idle ^ busy
+        return self.pins.get(pin, 0)
+
+    def delay_ms(self, delaytime):
+        self._advance(delaytime / 1000.0, 'delay_time')
+
+    def wait_busy(self, pin, idle, timeout=BUSY_TIMEOUT, poll=None):
+        self._busy_idle = idle
+        if poll is not None:
+            poll()
+        remaining = max(self._busy_until - self.stats['elapsed'], 0)
+        if timeout is not None and remaining > timeout:
+            self._advance(timeout, 'busy_time')
+            raise BusyTimeoutError("e-Paper busy for more than %s s" % timeout)
+        self._advance(remaining, 'busy_time')
+
+    def spi_writebyte(self, data):
+        self._write(data)
+
+    def spi_writebyte2(self, data):
+        for i in range(0, len(data), self.chunk_size):
+            self._write(data[i:i + self.chunk_size])
+
+    def spi_loopback(self, data):
+        received = bytearray(data)
+        self._advance(len(received) * 8 / self.speed_hz, 'spi_time')
+        if self.spi_limit is not None and self.speed_hz > self.spi_limit:
+            for i in range(0, len(received), 97):
+                received[i] ^= 0x01
+        return bytes(received)
+
+    def module_init(self):
+        return 0
+
+    def module_exit(self):
+        logging.debug("virtual panel: %s", self.stats)
+
+    # Rebuild an image from the last data written after 'command', e.g. 0x13
+    # or 0x24, for a panel of width x height. 1 bpp frames come back as mode
+    # '1', 2 and 4 bpp frames as mode 'L' holding the raw pixel codes scaled
+    # to 0..255. Returns None if nothing of a full frame's size was written.
+    # The bits are those in the panel RAM, whose polarity depends on the
+    # driver: epd7in5_V2 and the other drivers that send
+    # epdbuffer.invert(buf) (often just for the red plane) write 1 for black,
+    # so their frames come back as a negative unless invert is set.
+    def rasterize(self, command, width, height, invert=False):
+        from PIL import Image
+
+        data = bytes(self.ram.get(command, b''))
+        if invert:
+            data = data.translate(bytes(255 - i for i in range(256)))
+        linewidth = (width + 7) // 8
+        if len(data) == linewidth * height:
+            return Image.frombytes('1', (linewidth * 8, height), data).crop((0, 0, width, height))
+
+        for bits in (2, 4):
+            if len(data) * 8 == width * height * bits:
+                import numpy as np
+                mask = (1 << bits) - 1
+                shifts = np.arange(8 // bits - 1, -1, -1, dtype=np.uint8) * bits
+                codes = (np.frombuffer(data, dtype=np.uint8)[:, None] >> shifts) & mask
+                return Image.fromarray((codes * (255 // mask)).astype(np.uint8).reshape(height, width), 'L')
+        return None
+
+
+# EPD_BACKEND picks the interface to the panel:
+#   rpi      RPi.GPIO and spidev, chip select driven by hand
+#   spidev   RPi.GPIO and spidev, chip select driven by the kernel
+#   gpiod    libgpiod character device and spidev, kernel chip select
+#   pigpio   the pigpio daemon for GPIO and SPI
+#   jetson   Jetson.GPIO and software SPI
+#   virtual  no hardware, see Virtual
+# By default the Raspberry Pi (rpi) is used when its GPIO driver is present
+# and the Jetson Nano otherwise.
+BACKENDS = {
+    'rpi': RaspberryPi,
+    'spidev': RaspberryPiHardwareCS,
+    'gpiod': LibGpiod,
+    'pigpio': Pigpio,
+    'jetson': JetsonNano,
+    'virtual': Virtual,
+}
+
+backend = os.environ.get('EPD_BACKEND')
+if backend is None:
+    backend = 'rpi' if os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835') else 'jetson'
+if backend not in BACKENDS:
+    raise ValueError("EPD_BACKEND must be one of: %s" % ', '.join(BACKENDS))
+implementation = BACKENDS[backend]()
 
 for func in [x for x in dir(implementation) if not x.startswith('_')]:
     setattr(sys.modules[__name__], func, getattr(implementation, func))
 
 
+# Use the SPI settings of a panel model (see SPI_SETTINGS), with any of
+# speed_hz, mode or chunk_size overridden. They take effect at the next
+# module_init, i.e. the driver's init.
+def configure_spi(model=None, **overrides):
+    settings = spi_settings(model)
+    settings.update(overrides)
+    implementation.speed_hz = settings['speed_hz']
+    implementation.spi_mode = settings['mode']
+    implementation.chunk_size = settings['chunk_size']
+    logging.debug("SPI %s: %s", model or 'default', settings)
+
+
+# Step the SPI clock up through speeds and return the fastest one at which
+# data comes back intact from spi_loopback, or None if none does. Every step
+# uses the SPI mode and chunk size of model and re-initialises the bus at the
+# new clock. On a Raspberry Pi unplug the panel and wire MOSI (GPIO 10) to
+# MISO (GPIO 9) first. The settings in use before are restored afterwards.
+def calibrate_spi(speeds=SPI_SPEEDS, size=4096, rounds=3, model=None):
+    if not hasattr(implementation, 'spi_loopback'):
+        raise NotImplementedError("backend %s cannot read SPI back" % backend)
+
+    # the fixed patterns catch stuck and slow edges, the random rest the others
+    pattern = bytes([0x00, 0xFF, 0x55, 0xAA] * 16) + os.urandom(max(size - 64, 0))
+    saved = (implementation.speed_hz, implementation.spi_mode, implementation.chunk_size)
+    best = None
+    try:
+        for hz in speeds:
+            configure_spi(model, speed_hz=hz)
+            implementation.module_init()
+            if any(implementation.spi_loopback(pattern) != pattern for i in range(rounds)):
+                logging.info("SPI %d Hz: loopback mismatch", hz)
+                break
+            logging.info("SPI %d Hz: ok", hz)
+            best = hz
+    finally:
+        implementation.speed_hz, implementation.spi_mode, implementation.chunk_size = saved
+    return best
+
+
 ### END OF FILE ###
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Timings and counters of one refresh cycle. Stages that run more than once
+# in a cycle (BUSY waits, SPI transfers ...) add up.
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.ok = False
+        self._lock = threading.Lock()
+
+    # Time the enclosed block and add it to the named stage
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return {
+            'timestamp': round(self.started, 3),
+            'ok': self.ok,
+            'stages': {k: round(v, 6) for k, v in self.stages.items()},
+            'counters': dict(self.counters),
+        }
+
+    # Append the cycle as one JSON line
+    def write_json(self, path):
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.to_dict(), sort_keys=True) + '\n')
+
+    # Write the cycle in the Prometheus text format, e.g. for the node
+    # exporter textfile collector
+    def write_prometheus(self, path):
+        lines = [
+            '# HELP forecast_stage_seconds Time spent in each stage of the last refresh.',
+            '# TYPE forecast_stage_seconds gauge',
+        ]
+        for name, seconds in sorted(self.stages.items()):
+            lines.append(f'forecast_stage_seconds{{stage="{name}"}} {seconds:.6f}')
+
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE forecast_{name} gauge')
+            lines.append(f'forecast_{name} {value}')
+
+        lines.append('# TYPE forecast_last_refresh_success gauge')
+        lines.append(f'forecast_last_refresh_success {int(self.ok)}')
+        lines.append('# TYPE forecast_last_refresh_timestamp_seconds gauge')
+        lines.append(f'forecast_last_refresh_timestamp_seconds {self.started:.3f}')
+
+        # write to a temp file and rename so the collector never reads half a file
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+    def summary(self):
+        return ', '.join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.stages.items())
+
+# Metrics of the refresh cycle in progress, and of the cycle a worker thread
+# is bound to with use_cycle
+_cycle = None
+_local = threading.local()
+
+def start_cycle():
+    global _cycle
+    _cycle = Metrics()
+    return _cycle
+
+def current_cycle():
+    return getattr(_local, 'cycle', None) or _cycle
+
+# Record the stages run by this thread in cycle, e.g. for a panel push that
+# is still going when the next cycle starts
+@contextmanager
+def use_cycle(cycle):
+    _local.cycle = cycle
+    try:
+        yield
+    finally:
+        _local.cycle = None
+
+# Time a stage of the cycle in progress; a no-op outside of a cycle
+@contextmanager
+def stage(name):
+    cycle = current_cycle()
+    if cycle is None:
+        yield
+    else:
+        with cycle.stage(name):
+            yield
+
+def count(name, n=1):
+    cycle = current_cycle()
+    if cycle is not None:
+        cycle.count(name, n)
+
+# Wrap the transfer and BUSY functions of a waveshare_epd epdconfig module so
+# every cycle records SPI transfer and BUSY wait time, and counts the bytes,
+# commands and transfers sent. The drivers look these up on the module at
+# call time, so this works for every driver and backend.
+def instrument(epdconfig):
+    if getattr(epdconfig, '_instrumented', False):
+        return
+    epdconfig._instrumented = True
+
+    digital_write = epdconfig.digital_write
+    spi_writebyte = epdconfig.spi_writebyte
+    spi_writebyte2 = epdconfig.spi_writebyte2
+    wait_busy = epdconfig.wait_busy
+    dc = [0]
+
+    def traced_digital_write(pin, value):
+        if pin == epdconfig.DC_PIN:
+            dc[0] = value
+        digital_write(pin, value)
+
+    def traced_write(write):
+        def traced(data):
+            with stage('transfer'):
+                write(data)
+            count('spi_transfers')
+            count('spi_bytes', len(data))
+            if not dc[0]:
+                count('spi_commands', len(data))
+        return traced
+
+    def traced_wait_busy(*args, **kwargs):
+        with stage('busy'):
+            wait_busy(*args, **kwargs)
+
+    epdconfig.digital_write = traced_digital_write
+    epdconfig.spi_writebyte = traced_write(spi_writebyte)
+    epdconfig.spi_writebyte2 = traced_write(spi_writebyte2)
+    epdconfig.wait_busy = traced_wait_busy
@@ -1,16 +1,60 @@
 import os
-import requests
+import time
 import logging
+import threading
+from datetime import datetime, timezone
 
 from weatherprovider import WeatherProvider
 
 class OpenWeatherMap(WeatherProvider):
+    # the forecasts are the largest responses, give them longer to arrive
+    timeouts = {'data/2.5/forecast': (3.05, 20), 'data/2.5/onecall': (3.05, 20)}
+
+    # the forecast and air quality change far less often than the display
+    # refreshes, and a zip code never moves
+    ttls = {
+        'data/2.5/forecast': 3600,
+        'data/2.5/air_pollution': 1800,
+        'geo/1.0/zip': 30 * 24 * 3600,
+    }
+
+    # how long an API key without One Call access sticks to the separate
+    # requests before One Call is tried again
+    one_call_retry = 24 * 3600
+
     def __init__(self):
         logging.info("Loading OpenWeatherMap provider")
         self.api_key = os.environ["OPEN_WEATHER_MAP_API_KEY"]
         self.zip_code = os.environ["WEATHER_ZIP_CODE"]
 
-        self.endpoint = "http://api.openweathermap.org/data/2.5/"
+        self.endpoint = "http://api.openweathermap.org/"
+
+        # lat/lon of the zip code, known after the first get_weather or
+        # get_coordinates call
+        self.coord = None
+        self.city = None
+        self._geocoding = threading.Lock()
+
+        self._one_call = os.environ.get("OPEN_WEATHER_MAP_ONE_CALL", "1") != "0"
+
+    # Cache file recording that the API key has no One Call access, shared by
+    # every run so cron jobs don't each try One Call first
+    def _one_call_path(self):
+        return self._cache_path(f'{self.endpoint}data/2.5/onecall', (('appid', self.api_key),))
+
+    # Whether to try the One Call API: it isn't turned off and wasn't refused
+    # within the last one_call_retry seconds
+    @property
+    def one_call(self):
+        if not self._one_call:
+            return False
+        entry = self._cache_load(self._one_call_path())
+        return not entry or time.time() >= entry['expires']
+
+    # Remember that the API key has no One Call access
+    def one_call_unavailable(self):
+        now = time.time()
+        self._cache_save(self._one_call_path(), {'fetched': now, 'expires': now + self.one_call_retry})
 
     def _get(self):
         params = (
@@ -18,8 +62,7 @@ class OpenWeatherMap(WeatherProvider):
             ('appid', self.api_key),
             ('units', 'imperial'),
         )
-        response = requests.get(f'{self.endpoint}weather', params = params)
-        return response.json()
+        return self.get_json('data/2.5/weather', params)
 
     # Get the current weather conditions at given zip code
     def get_weather(self):
@@ -47,15 +90,85 @@ class OpenWeatherMap(WeatherProvider):
         w['category'] = d['weather'][0]['main']
         w['city'] = d['name']
         w['coord'] = d['coord']
+        self.coord = (d['coord']['lat'], d['coord']['lon'])
         w['sunrise'] = d['sys']['sunrise']
         w['sunset'] = d['sys']['sunrise']
         w['timezone'] = d['timezone']
         return w
 
-    # TODO: added stub to document. Replace current 2 calls with one call to get current and forecast data
-    def get_weather_one_call(self):
-        print('https://api.openweathermap.org/data/2.5/onecall?lat={lat}&lon={lon}&exclude={part}&appid={API key}')
-    
+    # Get the lat/lon and place name of the zip code. They are looked up once,
+    # by the first of the threads calling this at the same time.
+    def get_coordinates(self):
+        with self._geocoding:
+            if self.city is None:
+                params = (
+                    ('zip', f'{self.zip_code},us'),
+                    ('appid', self.api_key),
+                )
+                d = self.get_json('geo/1.0/zip', params)
+                self.coord = (d['lat'], d['lon'])
+                self.city = d['name']
+        return self.coord
+
+    # Get the current weather conditions and a daily forecast in one request.
+    # Returns (weather, forecast) in the same shapes as get_weather and
+    # get_forecast, with one forecast entry per day.
+    def get_weather_one_call(self, days):
+        if self.city is None:
+            self.get_coordinates()
+        lat, lon = self.coord
+        params = (
+            ('lat', lat),
+            ('lon', lon),
+            ('exclude', 'minutely,hourly,alerts'),
+            ('appid', self.api_key),
+            ('units', 'imperial'),
+        )
+        d = self.get_json('data/2.5/onecall', params)
+        c = d['current']
+
+        w = {}
+        w['zip_code'] = self.zip_code
+        w['temp'] = c['temp']
+        w['pressure'] = c['pressure']
+        w['pressure_unit'] = 'mb'
+        w['humidity'] = c['humidity']
+
+        if 'rain' in c:
+            w['rain'] = {
+                'rate': c['rain']['1h']
+            }
+
+        w['wind'] = {
+            'speed': c['wind_speed'],
+            'degree': c['wind_deg'],
+            'direction': self.cardinal_direction(c['wind_deg'])
+            }
+
+        w['uv'] = c['uvi']
+        w['dew_point'] = c['dew_point']
+
+        # Unique keys to Open Weather Map
+        w['description'] = c['weather'][0]['description']
+        w['category'] = c['weather'][0]['main']
+        w['city'] = self.city
+        w['coord'] = {'lat': lat, 'lon': lon}
+        w['sunrise'] = c['sunrise']
+        w['sunset'] = c['sunset']
+        w['timezone'] = d['timezone_offset']
+
+        f = {'daily': True, 'list': []}
+        for x in d['daily'][:days]:
+            f['list'].append({
+                'dt': x['dt'],
+                'dt_txt': datetime.fromtimestamp(x['dt'], timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+                'main': {'temp': x['temp']['day']},
+                'weather': x['weather'],
+                'wind': {'speed': x['wind_speed'], 'deg': x['wind_deg']},
+            })
+
+        return w, f
+
     # Get the 5 day forecast from openweathermap.org
     def get_forecast(self, days):
         cnt = days * 8 # API returns 8 data points for each day (3 hour intervals)
@@ -65,8 +178,7 @@ class OpenWeatherMap(WeatherProvider):
             ('cnt', cnt),
             ('units', 'imperial'),
         )
-        response = requests.get(f'{self.endpoint}forecast', params = params)
-        return response.json()
+        return self.get_json('data/2.5/forecast', params)
 
     # Get the air pollution data for the lat/lon
     def get_air_pollution(self, coords):
@@ -76,8 +188,7 @@ class OpenWeatherMap(WeatherProvider):
             ('lon', lon),
             ('appid', self.api_key),
         )
-        response = requests.get(f'{self.endpoint}air_pollution', params = params)
-        return response.json()
+        return self.get_json('data/2.5/air_pollution', params)
 
     def sample_data_weather(self):
         w = {
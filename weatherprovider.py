@@ -1,4 +1,155 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
 class WeatherProvider:
+    # Base URL of the provider API, set by each provider
+    endpoint = ''
+
+    # (connect, read) timeouts in seconds, per API name in timeouts
+    timeout = (3.05, 10)
+    timeouts = {}
+
+    # Failed requests are retried after 0.5, 1, 2 ... seconds
+    retries = 3
+    backoff = 0.5
+
+    # Seconds a response stays fresh in the on-disk cache, per API name. An
+    # HTTP Cache-Control max-age from the provider takes precedence.
+    ttl = 0
+    ttls = {}
+    cache_dir = os.environ.get(
+        'FORECAST_CACHE_DIR',
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache'))
+
+    _session = None
+    _session_lock = threading.Lock()
+
+    # HTTP session shared by all providers, so connections are kept alive
+    # between calls and between refreshes in daemon mode. The fetch threads
+    # ask for it at the same time, so only the first one creates it.
+    @classmethod
+    def session(cls):
+        with WeatherProvider._session_lock:
+            if WeatherProvider._session is None:
+                retry = Retry(
+                    total=cls.retries,
+                    backoff_factor=cls.backoff,
+                    status_forcelist=(429, 500, 502, 503, 504))
+                adapter = HTTPAdapter(pool_maxsize=4, max_retries=retry)
+
+                s = requests.Session()
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                WeatherProvider._session = s
+            return WeatherProvider._session
+
+    # Get the named API of the provider and return the decoded JSON response.
+    # Fresh responses come from the cache, expired ones are revalidated with
+    # their ETag, and a cached response is served stale if the provider
+    # cannot be reached or fails (see _transient). label names the call in the refresh timings, the API
+    # name by default.
+    def get_json(self, name, params, label=None):
+        with metrics.stage(f"fetch {label or name}"):
+            return self._get_json(name, params)
+
+    def _get_json(self, name, params):
+        url = f'{self.endpoint}{name}'
+        path = self._cache_path(url, params)
+        entry = self._cache_load(path)
+        now = time.time()
+
+        if entry and now < entry['expires']:
+            logging.debug(f"GET {url} from cache")
+            return entry['data']
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        logging.debug(f"GET {url}")
+        try:
+            response = self.session().get(url, params = params, headers = headers,
+                                          timeout = self.timeouts.get(name, self.timeout))
+            if response.status_code != 304 or not entry:
+                response.raise_for_status()
+                data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            if not entry or not self._transient(e):
+                raise
+            logging.warning(f"Using stale {name} data from {time.ctime(entry['fetched'])}: {e}")
+            return entry['data']
+
+        cache_control = response.headers.get('Cache-Control', '')
+        max_age = re.search(r'max-age=(\d+)', cache_control)
+        if 'no-cache' in cache_control:
+            ttl = 0
+        elif max_age:
+            ttl = int(max_age.group(1))
+        else:
+            ttl = self.ttls.get(name, self.ttl)
+
+        if response.status_code == 304:
+            logging.debug(f"{url} not modified")
+        else:
+            entry = {
+                'data': data,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+        entry['fetched'] = now
+        entry['expires'] = now + ttl
+
+        if 'no-store' not in cache_control:
+            self._cache_save(path, entry)
+        return entry['data']
+
+    # Whether a failed request may work later, so cached data can stand in:
+    # the provider can't be reached, has a server error or sent a body that
+    # isn't JSON. Client errors such as a bad or revoked API key are raised
+    # so they get noticed.
+    @staticmethod
+    def _transient(e):
+        if isinstance(e, requests.HTTPError):
+            return e.response is not None and e.response.status_code >= 500
+        return isinstance(e, (requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.RetryError, ValueError))
+
+    # Cache file for a request, named by a hash so the API keys in the
+    # params never end up in a file name
+    def _cache_path(self, url, params):
+        key = json.dumps([url, sorted(map(list, params))], default=str)
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def _cache_load(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _cache_save(self, path, entry):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write to a temp file and rename so readers never see half an entry
+            tmp = f"{path}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning(f"Could not cache response: {e}")
 
     # Return the cardinal direction based on the wind direction degree
     def cardinal_direction(self, degree):
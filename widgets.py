@@ -0,0 +1,146 @@
+import logging
+
+from PIL import Image,ImageChops,ImageDraw
+
+# One part of the display. values(data) picks what the widget shows from the
+# frame data (weather fields, a forecast day, the time ...) as a comparable
+# value, or None to show nothing. paint(draw, layer, xy, values) draws it at
+# xy, the top left of box, on a white layer the size of the frame. box
+# (x_start, y_start, x_end, y_end, ends exclusive) is the area laid out for
+# the widget; like text drawn straight onto the frame, long text runs past
+# it and is only cut off by the frame edges and the static pictures it runs
+# under, see Layout.
+class Widget:
+    def __init__(self, name, box, values, paint):
+        self.name = name
+        self.box = box
+        self.values = values
+        self.paint = paint
+
+    def flatten(self):
+        yield self
+
+    # Return the widget moved by dx, dy with prefix added to its name. select,
+    # if given, picks the part of the frame data the widget reads; the widget
+    # shows nothing while it returns None.
+    def moved(self, prefix, dx, dy, select=None):
+        values = self.values
+        if select is not None:
+            def selected(data, values=self.values):
+                data = select(data)
+                return None if data is None else values(data)
+            values = selected
+
+        x0, y0, x1, y1 = self.box
+        return Widget(prefix + self.name, (x0 + dx, y0 + dy, x1 + dx, y1 + dy), values, self.paint)
+
+    # Return the ink of the widget drawn with values on a frame of size as a
+    # mask and the box it covers, or (None, None) if nothing is drawn
+    def render(self, values, size):
+        if values is None:
+            return None, None
+
+        layer = Image.new('1', size, 255)  # 255: white
+        self.paint(ImageDraw.Draw(layer), layer, self.box[:2], values)
+        ink = ImageChops.invert(layer)
+        box = ink.getbbox()
+        if box is None:
+            return None, None
+        return ink.crop(box), box
+
+# Widgets positioned relative to origin, e.g. one forecast day card. select
+# picks the data the children read, see Widget.moved.
+class Group:
+    def __init__(self, name, origin, children, select=None):
+        self.name = name
+        self.origin = origin
+        self.children = children
+        self.select = select
+
+    def flatten(self):
+        x, y = self.origin
+        for child in self.children:
+            for widget in child.flatten():
+                yield widget.moved(f"{self.name}.", x, y, self.select)
+
+# Maps coordinates of a layout designed for one display size onto another.
+# Both axes are scaled by the same factor, so text and icons keep their
+# proportions, and the layout is centred along the axis with room to spare.
+class Scale:
+    def __init__(self, factor, dx=0, dy=0):
+        self.factor = factor
+        self.dx = dx
+        self.dy = dy
+
+    # The scale fitting a layout designed for design (width, height) to dims
+    @classmethod
+    def fit(cls, design, dims):
+        factor = min(dims[0] / design[0], dims[1] / design[1])
+        return cls(factor,
+            (dims[0] - round(design[0] * factor)) // 2,
+            (dims[1] - round(design[1] * factor)) // 2)
+
+    # The scale for coordinates relative to the design point x, y
+    def at(self, x, y):
+        return Scale(self.factor, self.dx + x * self.factor, self.dy + y * self.factor)
+
+    def x(self, x):
+        return round(self.dx + x * self.factor)
+
+    def y(self, y):
+        return round(self.dy + y * self.factor)
+
+    def xy(self, point):
+        return (self.x(point[0]), self.y(point[1]))
+
+    def box(self, box):
+        return self.xy(box[:2]) + self.xy(box[2:])
+
+    # A length such as a font size or line width, at least 1
+    def size(self, n):
+        return max(1, round(n * self.factor))
+
+def _overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+# A widget tree drawn over a static background. Keeps the frame and the ink
+# each widget last drew, so update() only renders the widgets whose values
+# changed and repaints just the area their old and new ink covers. Widgets
+# are drawn as ink over the background, so their ink may overlap: every
+# widget with ink in a repainted area is pasted again, and the frame always
+# matches drawing every widget from scratch. cover, if given, masks the
+# pictures of the background, which are pasted over the widget ink as if
+# drawn after it, hiding long text that runs under them.
+class Layout:
+    def __init__(self, background, tree, cover=None):
+        self.background = background
+        self.cover = cover
+        self.widgets = [widget for node in tree for widget in node.flatten()]
+        self.frame = background.copy()
+        self._values = {}
+        self._masks = {}
+        self._boxes = {}
+
+    # Bring the frame up to date with data and return the boxes that changed
+    def update(self, data):
+        boxes = []
+        for widget in self.widgets:
+            values = widget.values(data)
+            if widget.name in self._values and self._values[widget.name] == values:
+                continue
+            logging.debug(f"Widget {widget.name}: {values}")
+            self._values[widget.name] = values
+            old = self._boxes.get(widget.name)
+            self._masks[widget.name], self._boxes[widget.name] = widget.render(values, self.frame.size)
+            boxes.extend(box for box in {old, self._boxes[widget.name]} if box is not None)
+
+        for box in boxes:
+            self.frame.paste(self.background.crop(box), box[:2])
+        for widget in self.widgets:
+            box = self._boxes.get(widget.name)
+            if box is not None and any(_overlap(box, changed) for changed in boxes):
+                self.frame.paste(0, box, self._masks[widget.name])
+        if self.cover is not None:
+            for box in boxes:
+                self.frame.paste(self.background.crop(box), box[:2], self.cover.crop(box))
+        return boxes